@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Benchmark of loading and saving carStates.json.
+
+Compares the jsonpickle based json_helpers round trip with car_state_codec.
+
+    python3 benchmarks/bench_car_states.py [vins] [repeat]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import json_helpers  # noqa: E402
+import car_state_codec  # noqa: E402
+from car_state import CarState  # noqa: E402
+from car_states import CarStates  # noqa: E402
+
+
+def synthetic_states(vins):
+    carStates = CarStates()
+    for i in range(vins):
+        carStates['WVWZZZ3CZLE%07d' % i] = CarState(
+            i % 2 == 0, i % 3 == 0, i % 5 == 0, i % 100, i % 7 == 0)
+    return carStates
+
+
+def measure(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+
+def main():
+    vins = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    carStates = synthetic_states(vins)
+
+    legacy_text = json_helpers.to_json(carStates, unpicklable=True)
+    codec_text = car_state_codec.dumps(carStates)
+
+    # The codec has to keep reading files written by jsonpickle
+    migrated = car_state_codec.loads(legacy_text)
+    assert car_state_codec.dumps(migrated) == codec_text
+
+    results = [
+        ('save', measure(lambda: json_helpers.to_json(carStates, unpicklable=True), repeat),
+         measure(lambda: car_state_codec.dumps(carStates), repeat)),
+        ('load', measure(lambda: json_helpers.from_json(CarStates, legacy_text), repeat),
+         measure(lambda: car_state_codec.loads(codec_text), repeat)),
+    ]
+
+    print(f'{vins} vehicles')
+    print(f'{"":6}{"jsonpickle":>14}{"codec":>12}{"speedup":>10}')
+    for name, legacy, codec in results:
+        print(f'{name:6}{legacy:>11.3f} ms{codec:>9.3f} ms{legacy / codec:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
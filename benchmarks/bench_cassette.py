@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Records a login and a status sequence against the mock VW backend to a
+cassette, then replays it with artificial latency and no backend at all.
+
+The replay fails with CassetteError when the code sends a request that is
+not in the cassette, so an extra round trip shows up as an error instead of
+as a slightly slower run.
+
+    python3 benchmarks/bench_cassette.py [cassette] [latency seconds] [repeat]
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mock_backend import MockBackend, install  # noqa: E402
+from bench_commands import config, percentile  # noqa: E402
+
+SEQUENCE = [('', 'status'), ('locked', 'status'), ('climatisation', 'status'), ('charging', 'status')]
+
+
+def run(cassette, cacheTtl=0):
+    from car import Car
+    from state_store import JsonStateStore
+
+    logger = logging.getLogger('Bench')
+    logger.setLevel(logging.ERROR)
+    car = Car(logger, JsonStateStore(logger))
+    cfg = config(cacheTtl)
+    # Before getConnection, so that the login goes through the cassette too
+    car.pool.get(car.getCredentials(cfg)).set_cassette(cassette)
+    for command, value in SEQUENCE:
+        car.executeCommand(cfg, command, value)
+    car.pool.close()
+
+
+def in_workdir(fn):
+    workdir = tempfile.mkdtemp(prefix='bench_cassette.')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.perf_counter()
+        fn()
+        return (time.perf_counter()-start) * 1000
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def main():
+    from cassette import Cassette
+
+    path = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else 'status.cassette.json')
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    logging.disable(logging.ERROR)
+    backend = MockBackend().start()
+    uninstall = install(backend.url)
+    try:
+        in_workdir(lambda: run(Cassette(path, Cassette.RECORD)))
+        recorded = backend.stats()['requests']
+    finally:
+        uninstall()
+        backend.stop()
+
+    latencies = [in_workdir(lambda: run(Cassette(path, Cassette.REPLAY, latency))) for _ in range(repeat)]
+    print(f'Recorded {recorded} requests to {path}')
+    print(f'Replayed {repeat} times with {latency * 1000:g} ms per request: '
+          f'p50 {percentile(latencies, 50):.1f} ms, p95 {percentile(latencies, 95):.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+End-to-end latency of every command against the mock VW backend.
+
+Runs Car.executeCommand in this process (warm session) and main.py in a new
+process per call (what the plugin did before the worker), and reports
+p50/p95 latency, upstream requests and response bytes per command.
+
+    python3 benchmarks/bench_commands.py [repeat] [process repeat] [cacheTtl]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mock_backend import MockBackend, install  # noqa: E402
+
+COMMANDS = [
+    ('', 'status'),
+    ('locked', 'status'), ('locked', '0'), ('locked', '1'),
+    ('charging', 'status'), ('charging', '1'), ('charging', '0'),
+    ('climatisation', 'status'), ('climatisation', '1'), ('climatisation', '0'),
+    ('window-heating', 'status'), ('window-heating', '1'), ('window-heating', '0'),
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(p / 100 * (len(values)-1))))]
+
+
+def config(cacheTtl):
+    return {'username': 'bench@example.com', 'password': 'secret', 'spin': '1234',
+            'vin': '', 'temperature': 22.0, 'combineHeating': False,
+            'loggingLevel': 'ERROR', 'cacheTtl': cacheTtl,
+            # Measure the code, not the client side throttling
+            'rateLimits': {family: 0 for family in ('vsr', 'climater', 'charger', 'rolesrights', 'rlu', 'identity')}}
+
+
+def measure(backend, run, repeat):
+    latencies = []
+    requests = 0
+    received = 0
+    for _ in range(repeat):
+        backend.reset_stats()
+        start = time.perf_counter()
+        run()
+        latencies.append((time.perf_counter()-start) * 1000)
+        stats = backend.stats()
+        requests += stats['requests']
+        received += stats['bytes']
+    return {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+            'requests': requests / repeat, 'bytes': received / repeat}
+
+
+def report(title, rows):
+    print(title)
+    print(f'{"command":<24} {"p50 ms":>9} {"p95 ms":>9} {"requests":>9} {"bytes":>9}')
+    for name, r in rows:
+        print(f'{name:<24} {r["p50"]:9.1f} {r["p95"]:9.1f} {r["requests"]:9.1f} {r["bytes"]:9.0f}')
+    print()
+
+
+def bench_in_process(backend, repeat, cacheTtl):
+    from car import Car
+    from state_store import JsonStateStore
+
+    logger = logging.getLogger('Bench')
+    logger.setLevel(logging.ERROR)
+    car = Car(logger, JsonStateStore(logger))
+    cfg = config(cacheTtl)
+
+    rows = [('login', measure(backend, lambda: car.getConnection(cfg), 1))]
+    for command, value in COMMANDS:
+        rows.append(((command or 'all') + ' ' + value, measure(
+            backend, lambda: car.executeCommand(cfg, command, value), repeat)))
+    return rows
+
+
+def bench_process(backend, repeat, cacheTtl):
+    bootstrap = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_backend.py')
+    cfg = json.dumps(config(cacheTtl))
+
+    def run(command, value):
+        result = subprocess.run([sys.executable, bootstrap, '--backend', backend.url, cfg, command, value],
+                                capture_output=True, text=True)
+        if (not result.stdout.strip()):
+            raise RuntimeError(result.stderr)
+
+    rows = []
+    for command, value in COMMANDS:
+        rows.append(((command or 'all') + ' ' + value, measure(
+            backend, lambda: run(command, value), repeat)))
+    return rows
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    processRepeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    cacheTtl = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    logging.disable(logging.ERROR)
+    backend = MockBackend().start()
+    uninstall = install(backend.url)
+    workdir = tempfile.mkdtemp(prefix='bench_commands.')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        report(f'Car.executeCommand, warm session ({repeat} runs, cacheTtl {cacheTtl:g})',
+               bench_in_process(backend, repeat, cacheTtl))
+        report(f'main.py, one process per call ({processRepeat} runs, cacheTtl {cacheTtl:g})',
+               bench_process(backend, processRepeat, cacheTtl))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+        uninstall()
+        backend.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of VSR.parse on a large synthetic StoredVehicleDataResponse.
+
+Compares the compiled field index against the previous implementation,
+which scanned the whole field table for every field of the response.
+
+    python3 benchmarks/bench_vsr.py [blocks] [repeat]
+"""
+import os
+import sys
+import timeit
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from vsr import VSR  # noqa: E402
+
+LOCK_FIELDS = ['lock_left_front', 'lock_right_front',
+               'lock_left_rear', 'lock_right_rear', 'lock_trunk']
+
+logging.getLogger('VSR').setLevel(logging.ERROR)
+
+
+def legacy_parse(j):
+    rr = {}
+    j = j['StoredVehicleDataResponse']
+    rr['vin'] = j['vin']
+    for d in j['vehicleData']['data']:
+        if ('id' in d and 'field' in d):
+            for f in d['field']:
+                for e in VSR.FIELDS:
+                    if (e[1] == f['id']):
+                        if (e[2] not in rr):
+                            rr[e[2]] = {}
+                        rr[e[2]][e[3]] = 'null'
+                        if ('value' in f):
+                            if (len(e) == 5 and f['value'] in e[4]):
+                                rr[e[2]][e[3]] = e[4][f['value']]
+                            else:
+                                rr[e[2]][e[3]] = f['value'] if f['value'] else 'null'
+                        if ('unit' in f):
+                            rr[e[2]][e[3]] += ' '+f['unit']
+                        break
+    return rr
+
+
+def synthetic_response(blocks):
+    fields = []
+    for i, e in enumerate(VSR.FIELDS):
+        f = {'id': e[1], 'value': str(i % 4)}
+        if (i % 3 == 0):
+            f['unit'] = 'km'
+        fields.append(f)
+    data = [{'id': '0x0301FFFFFF', 'field': fields} for _ in range(blocks)]
+    return {'StoredVehicleDataResponse': {'vin': 'WVWZZZ3CZLE0000000', 'vehicleData': {'data': data}}}
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    response = synthetic_response(blocks)
+    parser = VSR()
+
+    assert parser.parse(response) == legacy_parse(response)
+
+    fields = blocks * len(VSR.FIELDS)
+    legacy = min(timeit.repeat(lambda: legacy_parse(response), number=1, repeat=repeat))
+    compiled = min(timeit.repeat(lambda: parser.parse(response), number=1, repeat=repeat))
+    locks = min(timeit.repeat(lambda: parser.parse(response, fields=LOCK_FIELDS), number=1, repeat=repeat))
+
+    print(f'{blocks} blocks, {fields} fields')
+    print(f'legacy scan:    {legacy * 1000:8.2f} ms')
+    print(f'compiled index: {compiled * 1000:8.2f} ms')
+    print(f'speedup:        {legacy / compiled:8.1f}x')
+    print(f'lock fields:    {locks * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
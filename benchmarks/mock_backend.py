@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the VW cloud, serving the fixtures in benchmarks/fixtures.
+
+Implements the identity login pages, tokenrefreshservice, mbboauth, the
+customer profile, homeRegion, vsr/climater/charger/heating status, the
+rolesrights security PIN flow and the rlu/rs/climater/charger actions.
+Actions change the state later status reads return, so lock then unlock
+behaves like a real car.
+
+Requests reach it through MockAdapter, which rewrites https://<host>/<path>
+to http://127.0.0.1:<port>/<host>/<path> and restores the original URL on
+the response, so WeConnect sees the real hosts.
+
+Run main.py against it:
+
+    python3 benchmarks/mock_backend.py '<config json>' <command> <value>
+    python3 benchmarks/mock_backend.py --backend http://127.0.0.1:8000 '<config json>' ...
+
+Without --backend a backend is started in the same process.
+"""
+import os
+import re
+import sys
+import json
+import threading
+import requests
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, urlencode
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+VINS = ['WVWZZZ3CZLE0000001']
+USER_ID = 'mock-user-id'
+LOCK_IDS = ('0x0301040001', '0x0301040004', '0x0301040007',
+            '0x030104000A', '0x030104000D')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def fixture_json(name):
+    return json.loads(fixture(name))
+
+
+class CarModel:
+    """State of one mocked car, changed by actions and read by status calls."""
+
+    def __init__(self, vin):
+        self.vin = vin
+        self.locked = True
+        self.climatisation = False
+        self.windowHeating = False
+        self.charging = False
+        self.heating = False
+        self.batteryLevel = 72
+
+    def vsr(self):
+        body = fixture_json('vsr.json')
+        body['StoredVehicleDataResponse']['vin'] = self.vin
+        for block in body['StoredVehicleDataResponse']['vehicleData']['data']:
+            for field in block['field']:
+                if (field['id'] in LOCK_IDS):
+                    field['value'] = '2' if self.locked else '3'
+        return body
+
+    def climater(self):
+        body = fixture_json('climater.json')
+        status = body['climater']['status']
+        status['climatisationStatusData']['climatisationState']['content'] = 'heating' if self.climatisation else 'off'
+        status['windowHeatingStatusData']['windowHeatingStateFront']['content'] = 'on' if self.windowHeating else 'off'
+        status['windowHeatingStatusData']['windowHeatingStateRear']['content'] = 'on' if self.windowHeating else 'off'
+        return body
+
+    def charger(self):
+        body = fixture_json('charger.json')
+        status = body['charger']['status']
+        status['chargingStatusData']['chargingState']['content'] = 'charging' if self.charging else 'off'
+        status['batteryStatusData']['stateOfCharge']['content'] = self.batteryLevel
+        return body
+
+    def heating_status(self):
+        body = fixture_json('heating.json')
+        body['statusResponse']['climatisationStateReport']['climatisationState'] = 'heating' if self.heating else 'off'
+        return body
+
+
+class MockBackend:
+    """
+    ThreadingHTTPServer on 127.0.0.1 serving the fixtures. Counts requests
+    and response bytes, see stats() and reset_stats().
+    """
+
+    def __init__(self, vins=VINS, port=0):
+        self.cars = {vin: CarModel(vin) for vin in vins}
+        self.requests = Counter()
+        self.bytes = 0
+        self.__lock = threading.Lock()
+        self.__routes = self.__build_routes()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body in one write, avoids delayed ACK stalls
+            wbufsize = 1 << 16
+
+            def do_GET(self):
+                backend.handle(self, 'GET')
+
+            def do_POST(self):
+                backend.handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(
+            target=self.server.serve_forever, name='MockBackend', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.__lock:
+            return {'requests': sum(self.requests.values()), 'bytes': self.bytes,
+                    'endpoints': dict(self.requests)}
+
+    def reset_stats(self):
+        with self.__lock:
+            self.requests.clear()
+            self.bytes = 0
+
+    def __build_routes(self):
+        vehicle = r'/vehicles/(?P<vin>[^/]+)'
+        return [
+            ('GET', 'identity.vwgroup.io', r'/oidc/v1/authorize', self.authorize),
+            ('POST', 'identity.vwgroup.io', r'/signin-service/v1/[^/]+/login/identifier', self.identifier),
+            ('POST', 'identity.vwgroup.io', r'/signin-service/v1/[^/]+/login/authenticate', self.authenticate),
+            ('GET', 'identity.vwgroup.io', r'/oidc/v1/oauth/client/callback/success', self.callback),
+            ('POST', 'tokenrefreshservice.apps.emea.vwapps.io', r'/(exchangeAuthCode|refreshTokens)', self.static('tokens.json')),
+            ('POST', 'mbboauth-1d.prd.ece.vwg-connect.com', r'/mbbcoauth/mobile/register/v1', self.static('register.json')),
+            ('POST', 'mbboauth-1d.prd.ece.vwg-connect.com', r'/mbbcoauth/mobile/oauth2/v1/token', self.static('oauth.json')),
+            ('GET', 'customer-profile.apps.emea.vwapps.io', r'/v1/customers/[^/]+/personalData', self.static('personalData.json')),
+            ('GET', 'customer-profile.apps.emea.vwapps.io', r'/v1/customers/[^/]+/realCarData', self.real_car_data),
+            ('GET', 'mal-1a.prd.ece.vwg-connect.com', r'/api/cs/vds/v1' + vehicle + r'/homeRegion', self.static('homeRegion.json')),
+            ('GET', 'mal-1a.prd.ece.vwg-connect.com', r'/api/rolesrights/authorization/v2' + vehicle + r'/services/.+/security-pin-auth-requested', self.static('security-pin-auth-requested.json')),
+            ('POST', 'mal-1a.prd.ece.vwg-connect.com', r'/api/rolesrights/authorization/v2/security-pin-auth-completed', self.static('security-pin-auth-completed.json')),
+            ('GET', 'msg.volkswagen.de', r'/fs-car/bs/vsr/v1/[^/]+/[^/]+' + vehicle + r'/status', self.car_status(CarModel.vsr)),
+            ('GET', 'msg.volkswagen.de', r'/fs-car/bs/climatisation/v1/[^/]+/[^/]+' + vehicle + r'/climater', self.car_status(CarModel.climater)),
+            ('GET', 'msg.volkswagen.de', r'/fs-car/bs/batterycharge/v1/[^/]+/[^/]+' + vehicle + r'/charger', self.car_status(CarModel.charger)),
+            ('GET', 'msg.volkswagen.de', r'/fs-car/bs/rs/v1/[^/]+/[^/]+' + vehicle + r'/status', self.car_status(CarModel.heating_status)),
+            ('POST', 'msg.volkswagen.de', r'/fs-car/bs/climatisation/v1/[^/]+/[^/]+' + vehicle + r'/climater/actions', self.climater_action),
+            ('POST', 'msg.volkswagen.de', r'/fs-car/bs/batterycharge/v1/[^/]+/[^/]+' + vehicle + r'/charger/actions', self.charger_action),
+            ('POST', 'msg.volkswagen.de', r'/fs-car/bs/rlu/v1/[^/]+/[^/]+' + vehicle + r'/actions', self.rlu_action),
+            ('POST', 'msg.volkswagen.de', r'/fs-car/bs/rs/v1/[^/]+/[^/]+' + vehicle + r'/actions', self.rs_action),
+        ]
+
+    def handle(self, request, method):
+        # Paths are /<original host>/<original path>
+        parsed = urlparse(request.path)
+        host, _, path = parsed.path[1:].partition('/')
+        path = '/' + path
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+
+        for route_method, route_host, pattern, handler in self.__routes:
+            m = re.fullmatch(pattern, path)
+            if (route_method == method and route_host == host and m):
+                try:
+                    status, headers, content = handler(body=body, **m.groupdict())
+                except KeyError:
+                    status, headers, content = self.json(
+                        {'error': {'errorCode': 'mbbc.rolesandrights.unknownVehicle', 'description': 'Vehicle not found'}}, 403)
+                with self.__lock:
+                    self.requests[route_host + pattern] += 1
+                break
+        else:
+            status, headers, content = 404, {'Content-Type': 'application/json'}, json.dumps(
+                {'error': {'errorCode': 'mock.not_found', 'description': method + ' ' + host + path}}).encode()
+
+        request.send_response(status)
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+        with self.__lock:
+            self.bytes += len(content)
+
+    def json(self, body, status=200):
+        return status, {'Content-Type': 'application/json;charset=UTF-8'}, json.dumps(body).encode()
+
+    def static(self, name):
+        content = fixture(name)
+        return lambda body, **kwargs: (200, {'Content-Type': 'application/json;charset=UTF-8'}, content)
+
+    def car(self, vin):
+        # A KeyError is answered with the backend's vehicle not found error
+        return self.cars[vin]
+
+    def car_status(self, read):
+        return lambda vin, body: self.json(read(self.car(vin)))
+
+    def authorize(self, body):
+        return 200, {'Content-Type': 'text/html;charset=UTF-8'}, fixture('authorize.html')
+
+    def identifier(self, body):
+        return 200, {'Content-Type': 'text/html;charset=UTF-8'}, fixture('identifier.html')
+
+    def authenticate(self, body):
+        query = urlencode({'user_id': USER_ID, 'relayState': 'mock-relay-state',
+                           'hmac': 'mock-callback-hmac'})
+        return 302, {'Location': 'https://identity.vwgroup.io/oidc/v1/oauth/client/callback/success?' + query}, b''
+
+    def callback(self, body):
+        fragment = urlencode({'state': 'mock-state', 'code': 'mock-auth-code',
+                              'access_token': 'mock-access-token', 'expires_in': 3600,
+                              'token_type': 'bearer', 'id_token': 'mock-id-token'})
+        return 302, {'Location': 'carnet://identity-kit/login#' + fragment}, b''
+
+    def real_car_data(self, body):
+        body = fixture_json('realCarData.json')
+        body['realCars'] = [{'vehicleIdentificationNumber': vin, 'nickname': 'Mock ' + vin[-4:],
+                             'deactivated': False} for vin in self.cars]
+        return self.json(body)
+
+    def action_response(self, action_type):
+        return self.json({'action': {'actionId': 1, 'actionState': 'queued', 'type': action_type}})
+
+    def climater_action(self, vin, body):
+        action_type = json.loads(body)['action']['type']
+        car = self.car(vin)
+        if (action_type in ('startClimatisation', 'stopClimatisation')):
+            car.climatisation = action_type == 'startClimatisation'
+        elif (action_type in ('startWindowHeating', 'stopWindowHeating')):
+            car.windowHeating = action_type == 'startWindowHeating'
+        return self.action_response(action_type)
+
+    def charger_action(self, vin, body):
+        action_type = json.loads(body)['action']['type']
+        self.car(vin).charging = action_type == 'start'
+        return self.action_response(action_type)
+
+    def rlu_action(self, vin, body):
+        self.car(vin).locked = b'<action>lock</action>' in body
+        return self.json({'rluActionResponse': {'requestId': '1', 'vin': vin}})
+
+    def rs_action(self, vin, body):
+        self.car(vin).heating = b'<quickstart>' in body
+        return self.json({'performActionResponse': {'requestId': '1', 'vin': vin}})
+
+
+class MockAdapter(requests.adapters.HTTPAdapter):
+    """Sends https requests to the mock backend, keeping the original URLs."""
+
+    def __init__(self, backend_url):
+        super().__init__()
+        self.backend_url = backend_url
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        original = request.url
+        parsed = urlparse(original)
+        request.url = self.backend_url + '/' + parsed.netloc + parsed.path + \
+            ('?' + parsed.query if parsed.query else '')
+        try:
+            response = super().send(request, stream=stream, timeout=timeout)
+        finally:
+            request.url = original
+        response.url = original
+        return response
+
+
+def install(backend_url):
+    """Mounts MockAdapter on every requests.Session created from now on."""
+    init = requests.Session.__init__
+
+    def patched(session, *args, **kwargs):
+        init(session, *args, **kwargs)
+        session.mount('https://', MockAdapter(backend_url))
+
+    requests.Session.__init__ = patched
+    return lambda: setattr(requests.Session, '__init__', init)
+
+
+def main():
+    args = sys.argv[1:]
+    backend = None
+    if (args[:1] == ['--backend']):
+        backend_url = args[1]
+        args = args[2:]
+    else:
+        backend = MockBackend().start()
+        backend_url = backend.url
+
+    install(backend_url)
+    sys.path.insert(0, SRC)
+    # main.py changes to the directory of argv[0], which runpy would set to
+    # src. A relative argv[0] keeps it in the current working directory
+    sys.argv = ['main.py'] + args
+    path = os.path.join(SRC, 'main.py')
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    try:
+        exec(code, {'__name__': '__main__', '__file__': path})
+    finally:
+        if (backend):
+            backend.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,12 +14,21 @@ import os
 import base64
 import hashlib
 import pickle
+import threading
 import requests
+from concurrent.futures import Future
 from urllib.parse import urlparse, unquote_plus
 from bs4 import BeautifulSoup
 import logging
 from vsr import VSR
 from credentials import Credentials
+from response_cache import ResponseCache
+from file_helpers import atomic_write, FileLock
+from retry_policy import RetryPolicy, CircuitBreaker, deadline, remaining
+from rate_limiter import RateLimiter
+from cassette import Cassette
+import tracing
+import metrics
 import yaml
 
 logging.basicConfig(
@@ -37,13 +46,31 @@ class VWError(Exception):
 
 
 class UrlError(VWError):
-    def __init__(self, status_code, message, request):
+    def __init__(self, status_code, message, request, error_code=None):
         self.status_code = status_code
         self.request = request
+        self.error_code = error_code
         super().__init__(message)
     pass
 
 
+class CircuitOpenError(VWError):
+    def __init__(self, host):
+        self.host = host
+        super().__init__('Circuit open: {} is failing, not sending requests'.format(host))
+
+
+class DeadlineExceededError(VWError):
+    def __init__(self, url):
+        super().__init__('Deadline exceeded before sending request to {}'.format(url))
+
+
+class RateLimitedError(VWError):
+    def __init__(self, family):
+        self.family = family
+        super().__init__('Rate limit of {} requests reached'.format(family))
+
+
 def get_random_string(length=12,
                       allowed_chars='abcdefghijklmnopqrstuvwxyz'
                                     'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-'):
@@ -64,6 +91,15 @@ def base64URLEncode(s):
     return base64.urlsafe_b64encode(s).rstrip(b'=')
 
 
+def jwt_claims(token):
+    # Claims of a JWT, without verifying it. Empty when it is not a JWT
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (AttributeError, IndexError, ValueError):
+        return {}
+
+
 def get_url_params(url):
     args = url.split('?')
     blocks = args[-1].split('#')
@@ -100,32 +136,106 @@ class CarNetAdapter(requests.adapters.HTTPAdapter):
 
 
 class WeConnect():
-    __session = None
     __dashboard = None
     __edit_profile_url = None
     SESSION_FILE = 'weconnectAPI.session'
     ACCESS_FILE = 'weconnectAPI.access'
+    LOCK_FILE = 'weconnectAPI.lock'
+    REGIONS_FILE = 'weconnectAPI.regions'
+    REGION_TTL = 30*24*3600
+    VINS_FILE = 'weconnectAPI.vins'
+    RATE_LIMIT_FILE = 'weconnectAPI.ratelimit'
+    # Seconds the discovered VINs are used before they are looked up again
+    VINS_TTL = 24*3600
+    CACHE_DIR = 'weconnectAPI.cache'
+    # Seconds a status response may be reused, per endpoint
+    CACHE_TTL = {'vsr': 5, 'climater': 5, 'charger': 5, 'heating': 5}
+    # Upper bound for reusing a security token, the backend may reject it earlier
+    SECURE_TOKEN_TTL = 900
+    # Seconds before expiry a token is already treated as expired
+    TOKEN_EXPIRY_SKEW = 30
+    # (connect, read) timeout in seconds of every request
+    REQUEST_TIMEOUT = (10, 30)
+    # Host health is the same for every account, so both are shared
+    RETRY_POLICY = RetryPolicy()
+    CIRCUIT_BREAKER = CircuitBreaker()
     BASE_URL = 'https://msg.volkswagen.de/fs-car'
     TOKEN_URL = 'https://tokenrefreshservice.apps.emea.vwapps.io'
     PROFILE_URL = 'https://customer-profile.apps.emea.vwapps.io/v1/customers/{}'
     OAUTH_URL = 'https://mbboauth-1d.prd.ece.vwg-connect.com/mbbcoauth/mobile/oauth2/v1/token'
     USER_URL = 'https://userinformationservice.apps.emea.vwapps.io/iaa'
     MAL_URL = 'https://mal-1a.prd.ece.vwg-connect.com/api'
-    __tokens = None
-    __credentials = {}
-    __x_client_id = None
-    __oauth = {}
     __accept_mbb = 'application/json, application/vnd.volkswagenag.com-error-v1+json, */*'
     __brand = 'VW'
     __country = 'DE'
 
-    def __get_url(self, url, get=None, post=None, json=None, cookies=None, headers=None):
-        if (post == None and json == None):
+    def __timeout(self, url):
+        # REQUEST_TIMEOUT, cut short by the deadline of the caller
+        left = remaining()
+        if (left is None):
+            return self.REQUEST_TIMEOUT
+        if (left <= 0):
+            raise DeadlineExceededError(url)
+        return tuple(min(t, left) for t in self.REQUEST_TIMEOUT)
+
+    def __send(self, method, url, get, post, json, cookies, headers, timeout):
+        if (self.__cassette and self.__cassette.replaying):
+            return self.__cassette.replay(method, url, get)
+        if (method == 'GET'):
             r = self.__session.get(
-                url, params=get, headers=headers, cookies=cookies)
+                url, params=get, headers=headers, cookies=cookies, timeout=timeout)
         else:
             r = self.__session.post(
-                url, data=post, json=json, params=get, headers=headers, cookies=cookies)
+                url, data=post, json=json, params=get, headers=headers, cookies=cookies, timeout=timeout)
+        if (self.__cassette):
+            self.__cassette.record(method, url, get, post if json is None else json, headers, r)
+        return r
+
+    def __get_url(self, url, get=None, post=None, json=None, cookies=None, headers=None):
+        method = 'GET' if (post == None and json == None) else 'POST'
+        host = urlparse(url).netloc
+        labels = {'account': self.account, 'vin': metrics.hashed(self.__get_vin(url)),
+                  'endpoint': metrics.endpoint(url), 'method': method}
+        start = time.perf_counter()
+        with tracing.span('request', method=method, host=host) as span:
+            attempt = 0
+            while True:
+                timeout = self.__timeout(url)
+                if (not self.CIRCUIT_BREAKER.allow(host)):
+                    raise CircuitOpenError(host)
+                try:
+                    r = self.__send(method, url, get, post, json, cookies, headers, timeout)
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                    self.CIRCUIT_BREAKER.failure(host)
+                    delay = self.RETRY_POLICY.delay(method, attempt, error=e)
+                    if (delay is None):
+                        metrics.REQUEST_SECONDS.observe(time.perf_counter()-start, **labels)
+                        metrics.REQUESTS.inc(status='error', **labels)
+                        raise
+                    metrics.RETRIES.inc(account=self.account, endpoint=labels['endpoint'], reason=type(e).__name__)
+                    logger.warning('%s request to %s failed (%s), retrying in %.1f s', method, host, e, delay)
+                except BaseException:
+                    # SSL errors, redirect loops, broken bodies... Whatever it
+                    # was, a half open circuit must learn how its probe ended
+                    self.CIRCUIT_BREAKER.failure(host)
+                    metrics.REQUEST_SECONDS.observe(time.perf_counter()-start, **labels)
+                    metrics.REQUESTS.inc(status='error', **labels)
+                    raise
+                else:
+                    if (r.status_code >= 500):
+                        self.CIRCUIT_BREAKER.failure(host)
+                    else:
+                        self.CIRCUIT_BREAKER.success(host)
+                    delay = self.RETRY_POLICY.delay(method, attempt, response=r)
+                    if (delay is None):
+                        break
+                    metrics.RETRIES.inc(account=self.account, endpoint=labels['endpoint'], reason=str(r.status_code))
+                    logger.warning('%s request to %s returned %d, retrying in %.1f s', method, host, r.status_code, delay)
+                time.sleep(delay)
+                attempt += 1
+            span.set(status=r.status_code, bytes=len(r.content or b''), attempts=attempt+1)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter()-start, **labels)
+        metrics.REQUESTS.inc(status=r.status_code, **labels)
         logger.info('Sending %s request to %s', r.request.method, r.url)
         logger.debug('Parameters: %s', r.request.url)
         logger.debug('Headers: %s', r.request.headers)
@@ -133,6 +243,7 @@ class WeConnect():
         logger.debug('Headers: %s', r.headers)
         logger.debug('History: %s', r.history)
         if r.status_code >= 400:
+            code = None
             try:
                 e = r.json()
                 msg = 'Error {}'.format(r.status_code)
@@ -140,24 +251,91 @@ class WeConnect():
                 if ('error' in e):
                     msg += ':'
                     if ('errorCode' in e['error']):
-                        msg += ' [{}]'.format(e['error']['errorCode'])
+                        code = e['error']['errorCode']
+                        msg += ' [{}]'.format(code)
                     if ('description' in e['error']):
                         msg += ' '+e['error']['description']
             except ValueError:
                 logger.debug('Response error is not JSON format')
                 msg = "Error: status code {}".format(r.status_code)
-            raise UrlError(r.status_code, msg, r)
+            raise UrlError(r.status_code, msg, r, code)
         # else:
         #    print(r.content.decode())
         return r
 
-    def __command(self, command, post=None, data=None, dashboard=None, accept='application/json', content_type=None, scope=None, secure_token=None):
+    def __get_vin(self, command):
+        m = re.search(r'/vehicles?/([^/?]+)', command)
+        return m.group(1) if m else None
+
+    def __coalesce(self, vin, cache, fetch):
+        # Concurrent reads of the same endpoint and VIN share one request
+        key = (vin, cache)
+        with self.__inflight_lock:
+            future = self.__inflight.get(key)
+            leader = future is None
+            if (leader):
+                future = Future()
+                self.__inflight[key] = future
+        if (not leader):
+            logger.debug('Waiting for in-flight %s request for %s', cache, vin)
+            self.__count_cache(vin, cache, 'coalesced')
+            with tracing.span('coalesced', endpoint=cache):
+                return future.result()
+
+        try:
+            if (self.__cache_ttl[cache] > 0):
+                # A process already fetching it finishes first, fetch() then
+                # finds its response in the cache
+                with FileLock(self.__response_cache.lock_path(vin, cache)):
+                    result = fetch()
+            else:
+                result = fetch()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.__inflight_lock:
+                del self.__inflight[key]
+
+    def __count_cache(self, vin, cache, result):
+        metrics.CACHE.inc(account=self.account, vin=metrics.hashed(vin), endpoint=cache, result=result)
+
+    def __command(self, command, post=None, data=None, dashboard=None, accept='application/json', content_type=None, scope=None, secure_token=None, cache=None, coalesced=False, rate_limited=True):
         if (not dashboard):
             dashboard = self.__dashboard
         if (not scope):
             scope = self.__tokens
         command = command.format(brand=self.__brand, country=self.__country)
         logger.info('Preparing command: %s', command)
+        vin = self.__get_vin(command)
+        if (post or data):
+            cache = None
+        # A TTL of 0 turns the cache off, nothing is read from or written to it
+        caching = bool(cache and vin and self.__cache_ttl[cache] > 0)
+        if (cache and vin):
+            jr = self.__response_cache.get(vin, cache, self.__cache_ttl[cache]) if caching else None
+            if (jr is not None):
+                logger.info('Using cached %s response', cache)
+                self.__count_cache(vin, cache, 'hit')
+                return jr
+            if (not coalesced):
+                return self.__coalesce(vin, cache, lambda: self.__command(
+                    command, dashboard=dashboard, accept=accept, scope=scope, cache=cache, coalesced=True))
+        # An expired entry still answers rate limited and unmodified reads
+        entry = self.__response_cache.get_entry(vin, cache) if caching else None
+        family = self.__rate_limiter.family(command) if rate_limited else None
+        if (not self.__rate_limiter.try_acquire(family)):
+            # Better an older status than waiting for the bucket to refill
+            if (entry):
+                logger.info('Rate limit of %s reached, using cached %s response', family, cache)
+                self.__count_cache(vin, cache, 'stale')
+                return entry['body']
+            with tracing.span('rate-limit', family=family):
+                acquired = self.__rate_limiter.acquire(family)
+            if (not acquired):
+                raise RateLimitedError(family)
         if (post):
             logger.debug('JSON data: %s', post)
         if (data):
@@ -172,8 +350,7 @@ class WeConnect():
         if (secure_token):
             logger.debug('Secure token: %s', secure_token)
         try:
-            if (not self.__check_tokens()):
-                self.__force_login()
+            self.__ensure_tokens()
         except UrlError as e:
             raise VWError(
                 'Aborting command {}: login failed ({})'.format(command, e.message))
@@ -188,15 +365,60 @@ class WeConnect():
             headers['Content-Type'] = content_type
         if (secure_token):
             headers['X-MBBSecToken'] = secure_token
-        r = self.__get_url(dashboard+command, json=post,
-                           post=data, headers=headers)
+        if (entry and entry.get('etag')):
+            headers['If-None-Match'] = entry['etag']
+        if (entry and entry.get('last_modified')):
+            headers['If-Modified-Since'] = entry['last_modified']
+        timestamp = time.time()
+        try:
+            r = self.__get_url(dashboard+command, json=post,
+                               post=data, headers=headers)
+        except (UrlError, requests.exceptions.RequestException) as e:
+            dashboard = self.__refresh_region(vin, dashboard, e)
+            # Only reads are safe to repeat in the new region
+            if (not dashboard or post or data):
+                raise
+            r = self.__get_url(dashboard+command, headers=headers)
+        finally:
+            if ((post or data) and vin and command.split('?')[0].endswith('/actions')):
+                # The car state is about to change, never serve it from cache.
+                # Also after an error, the backend may have acted before it
+                self.__response_cache.invalidate(vin)
+        if (r.status_code == 304 and entry):
+            logger.info('%s not modified, using cached response', cache)
+            self.__count_cache(vin, cache, 'not_modified')
+            self.__response_cache.put(vin, cache, entry['body'], timestamp,
+                                      r.headers.get('ETag', entry.get('etag')),
+                                      r.headers.get('Last-Modified', entry.get('last_modified')))
+            return entry['body']
         if ('json' in r.headers.get('Content-Type', [])):
-            jr = r.json()
+            with tracing.span('parse', bytes=len(r.content)):
+                jr = r.json()
+            if (caching):
+                self.__count_cache(vin, cache, 'miss')
+                self.__response_cache.put(vin, cache, jr, timestamp,
+                                          r.headers.get('ETag'), r.headers.get('Last-Modified'))
             return jr
         return r
 
     def __init__(self, credentials: Credentials):
         self.__session = requests.Session()
+        self.__cassette = Cassette.from_environment()
+        self.__auth_lock = threading.RLock()
+        self.__tokens = None
+        self.__identities = {}
+        self.__identity_kit = None
+        self.__x_client_id = None
+        self.__oauth = {}
+        self.__secure_tokens = {}
+        self.__regions = {}
+        self.__regions_lock = threading.Lock()
+        self.__vins = None
+        self.__vins_lock = threading.Lock()
+        self.__vins_refresh = None
+        self.__inflight = {}
+        self.__inflight_lock = threading.Lock()
+        self.__credentials = {}
         self.__credentials['user'] = credentials.username
         self.__credentials['password'] = credentials.password
         self.__credentials['spin'] = None
@@ -214,22 +436,94 @@ class WeConnect():
             else:
                 raise VWError('Wrong S-PIN format: must be 4-digits')
 
+        # Every account gets its own session, access, regions, lock and cache
+        self.account = hashlib.sha256(
+            credentials.username.encode('utf-8')).hexdigest()[:12]
+        self.__session_file = self.__account_file(WeConnect.SESSION_FILE)
+        self.__access_file = self.__account_file(WeConnect.ACCESS_FILE)
+        self.__regions_file = self.__account_file(WeConnect.REGIONS_FILE)
+        self.__lock_file = self.__account_file(WeConnect.LOCK_FILE)
+        self.__vins_file = self.__account_file(WeConnect.VINS_FILE)
+        # VW throttles per account, so the buckets are kept per account
+        self.__rate_limiter = RateLimiter(
+            self.__account_file(WeConnect.RATE_LIMIT_FILE))
+        self.__response_cache = ResponseCache(
+            os.path.join(WeConnect.CACHE_DIR, self.account))
+        self.__cache_ttl = dict(WeConnect.CACHE_TTL)
+
+        # Every account looks at the same legacy files, so one lock for all
+        with FileLock(WeConnect.LOCK_FILE):
+            self.__adopt_legacy_files()
+        self.__load_access()
+        try:
+            with open(self.__regions_file, 'r') as f:
+                self.__regions = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.__regions = {}
+        self.__session.mount("carnet://", CarNetAdapter())
+
+    def __account_file(self, name):
+        # weconnectAPI.access -> weconnectAPI.<account>.access
+        base, ext = os.path.splitext(name)
+        return base + '.' + self.account + ext
+
+    def __legacy_owner(self):
+        # The legacy files hold the tokens of whichever account was configured
+        # back then: True when they prove it was this one, False when another,
+        # None when they do not tell
+        try:
+            with open(WeConnect.ACCESS_FILE, 'r') as f:
+                d = json.load(f)
+        except ValueError:
+            return None
+        if (d.get('account')):
+            return d['account'] == self.account
+        email = jwt_claims((d.get('tokens') or {}).get('id_token')).get('email')
+        if (not email):
+            return None
+        return email.lower() == self.__credentials['user'].lower()
+
+    def __adopt_legacy_files(self):
+        if (not os.path.exists(WeConnect.ACCESS_FILE)):
+            return
+        owner = self.__legacy_owner()
+        if (owner is False):
+            return
+        if (owner is None or os.path.exists(self.__access_file)):
+            # A login is cheaper than sending commands to another user's car
+            logger.warning('Deleting legacy access files that cannot be adopted')
+            for legacy in (WeConnect.SESSION_FILE, WeConnect.ACCESS_FILE, WeConnect.REGIONS_FILE):
+                try:
+                    os.remove(legacy)
+                except FileNotFoundError:
+                    pass
+            return
+        logger.info('Moving access files to account %s', self.account)
+        for legacy, path in ((WeConnect.SESSION_FILE, self.__session_file),
+                             (WeConnect.ACCESS_FILE, self.__access_file),
+                             (WeConnect.REGIONS_FILE, self.__regions_file)):
+            try:
+                os.replace(legacy, path)
+            except FileNotFoundError:
+                pass
+
+    def __load_access(self):
         try:
-            with open(WeConnect.SESSION_FILE, 'rb') as f:
+            with open(self.__session_file, 'rb') as f:
                 self.__session.cookies.update(pickle.load(f))
         except FileNotFoundError:
             logger.warning('Session file not found')
         try:
-            with open(WeConnect.ACCESS_FILE, 'rb') as f:
+            with open(self.__access_file, 'rb') as f:
                 d = json.load(f)
                 self.__identities = d['identities']
                 self.__identity_kit = d['identity_kit']
                 self.__tokens = d['tokens']
                 self.__x_client_id = d['x-client-id']
                 self.__oauth = d['oauth']
+                self.__secure_tokens = d.get('secure_tokens', {})
         except FileNotFoundError:
             logger.warning('Access file not found')
-        self.__session.mount("carnet://", CarNetAdapter())
 
     def __refresh_oauth_scope(self, scope):
         data = {
@@ -242,46 +536,84 @@ class WeConnect():
                            'X-Client-Id': self.__x_client_id})
         logger.debug('Refreshed OAuth scope %s', scope)
         jr = r.json()
+        # Complete before it is published, commands check it without the lock
+        jr['timestamp'] = time.time()
+        jr['__name__'] = 'OAuth '+scope
         self.__oauth[scope] = jr
-        self.__oauth[scope]['timestamp'] = time.time()
-        self.__oauth[scope]['__name__'] = 'OAuth '+scope
         self.__save_access()
 
-    def __check_kit_tokens(self):
+    def __check_kit_tokens(self, margin=TOKEN_EXPIRY_SKEW):
         if (self.__tokens):
-            if (self.__tokens['timestamp']+self.__tokens['expires_in'] > time.time()):
+            if (self.__tokens['timestamp']+self.__tokens['expires_in']-margin > time.time()):
                 logger.debug('Tokens still valid')
                 return True
             logger.debug('Token expired. Refreshing tokens')
+            metrics.AUTH.inc(account=self.account, kind='refresh')
             r = self.__get_url(self.TOKEN_URL+'/refreshTokens',
                                post={'refresh_token': self.__tokens['refresh_token']})
-            self.__tokens = r.json()
-            self.__tokens['timestamp'] = time.time()
-            self.__tokens['__name__'] = 'Token'
+            tokens = r.json()
+            tokens['timestamp'] = time.time()
+            tokens['__name__'] = 'Token'
+            self.__tokens = tokens
             self.__save_access()
             return True
         logger.debug('Token checking failed')
         return False
 
-    def __check_oauth_scope(self, scope):
+    def __check_oauth_scope(self, scope, margin=TOKEN_EXPIRY_SKEW):
         if (scope in self.__oauth and self.__oauth[scope]):
-            if (self.__oauth[scope]['timestamp']+self.__oauth[scope]['expires_in'] > time.time()):
+            if (self.__oauth[scope]['timestamp']+self.__oauth[scope]['expires_in']-margin > time.time()):
                 logger.debug('OAuth %s still valid', scope)
                 return True
             logger.debug('OAUth %s expired. Refreshing', scope)
             if (scope in self.__oauth and 'refresh_token' in self.__oauth[scope]):
+                metrics.AUTH.inc(account=self.account, kind='refresh')
                 self.__refresh_oauth_scope(scope)
                 return True
             logger.error('OAUTH {} not present. Cannot refresh'.format(scope))
         logger.debug('OAuth [%s] checking failed', scope)
         return False
 
-    def __check_oauth_tokens(self):
-        return self.__check_oauth_scope('sc2:fal') and self.__check_oauth_scope('t2_v:cubic')
+    def __check_oauth_tokens(self, margin=TOKEN_EXPIRY_SKEW):
+        return self.__check_oauth_scope('sc2:fal', margin) and self.__check_oauth_scope('t2_v:cubic', margin)
 
-    def __check_tokens(self):
+    def __check_tokens(self, margin=TOKEN_EXPIRY_SKEW):
         logger.debug('Checking tokens')
-        return self.__check_kit_tokens() and self.__check_oauth_tokens()
+        return self.__check_kit_tokens(margin) and self.__check_oauth_tokens(margin)
+
+    def tokens_expire_at(self):
+        # Earliest expiry of the kit tokens and OAuth scopes, None when not logged in
+        tokens = [self.__tokens, self.__oauth.get('sc2:fal'), self.__oauth.get('t2_v:cubic')]
+        if (not all(tokens)):
+            return None
+        return min(t['timestamp']+t['expires_in'] for t in tokens)
+
+    def __tokens_valid(self, margin=TOKEN_EXPIRY_SKEW):
+        expires_at = self.tokens_expire_at()
+        return expires_at is not None and expires_at-margin > time.time()
+
+    def __ensure_tokens(self, margin=TOKEN_EXPIRY_SKEW):
+        # Valid tokens never wait for a refresh running in another thread,
+        # expired ones share one refresh or login with the other threads and
+        # processes
+        if (self.__tokens_valid(margin)):
+            return
+        # Never cut short by the deadline of the command that needed it, an
+        # aborted login would start over on every request
+        with self.__auth_lock, deadline(None):
+            if (self.__tokens_valid(margin)):
+                return
+            with tracing.span('auth'), FileLock(self.__lock_file):
+                # Another process may have refreshed while we were waiting
+                self.__load_access()
+                if (not self.__check_tokens(margin)):
+                    metrics.AUTH.inc(account=self.account, kind='login')
+                    with tracing.span('login'):
+                        self.__force_login()
+
+    def refresh_tokens(self, margin):
+        # Refreshes every token expiring within margin seconds
+        self.__ensure_tokens(margin)
 
     def __get_idk(self, soup):
         scripts = soup.find_all('script')
@@ -305,14 +637,28 @@ class WeConnect():
         t['tokens'] = self.__tokens
         t['x-client-id'] = self.__x_client_id
         t['oauth'] = self.__oauth
-        with open(WeConnect.ACCESS_FILE, 'w') as f:
-            json.dump(t, f)
+        t['secure_tokens'] = self.__secure_tokens
+        t['account'] = self.account
+        atomic_write(self.__access_file, json.dumps(t))
         logger.info('Saving access to file')
 
+    def __save_session(self):
+        atomic_write(self.__session_file,
+                     pickle.dumps(self.__session.cookies), mode='wb')
+        logger.debug('Saving session')
+
+    def persist(self):
+        # Tokens are saved whenever they change, only the cookies are missing.
+        # Releases the pooled connections, a new instance resumes from disk
+        with self.__auth_lock:
+            if (self.__tokens):
+                with FileLock(self.__lock_file):
+                    self.__save_session()
+        self.__session.close()
+
     def login(self):
         logger.info('logger')
-        if (not self.__check_tokens()):
-            return self.__force_login()
+        self.__ensure_tokens()
         return True
 
     def __parse_market_consent(self, r):
@@ -459,9 +805,10 @@ class WeConnect():
         logger.info('Requesting Tokens')
         r = self.__get_url(
             'https://tokenrefreshservice.apps.emea.vwapps.io/exchangeAuthCode', post=data)
-        self.__tokens = r.json()
-        self.__tokens['timestamp'] = time.time()
-        self.__tokens['__name__'] = 'Token'
+        tokens = r.json()
+        tokens['timestamp'] = time.time()
+        tokens['__name__'] = 'Token'
+        self.__tokens = tokens
         logger.info('Received Tokens')
         if (not self.__x_client_id):
             logger.warning('X-client-id not found. Requesting a new one')
@@ -489,18 +836,18 @@ class WeConnect():
         logger.info('Received OAuth [fal]')
         jr = r.json()
 
+        jr['timestamp'] = time.time()
+        jr['__name__'] = 'OAuth sc2:fal'
         self.__oauth['sc2:fal'] = jr
-        self.__oauth['sc2:fal']['timestamp'] = time.time()
-        self.__oauth['sc2:fal']['__name__'] = 'OAuth sc2:fal'
         logger.debug('OAuth [fal] timestamp = %s', time.time())
         logger.info('Requesting OAuth [cubic]')
         self.__refresh_oauth_scope('t2_v:cubic')
         logger.debug('Received OAuth [cubic]')
-        with open(WeConnect.SESSION_FILE, 'wb') as f:
-            pickle.dump(self.__session.cookies, f)
-        logger.debug('Saving session')
+        self.__save_session()
         logger.info('Requesting personal data')
-        r = self.get_personal_data()
+        # Part of the login, which never waits for or fails on a rate limit
+        r = self.__command(
+            '/personalData', dashboard=self.__identities['profile_url'], rate_limited=False)
         self.__identities['business_id'] = r['businessIdentifierValue']
         logger.info('Received business identity')
         logger.debug('Bussiness identity = %s', r['businessIdentifierValue'])
@@ -509,25 +856,108 @@ class WeConnect():
     def __get_homeregion(self, vin):
         r = self.__command('/cs/vds/v1/vehicles/'+vin+'/homeRegion',
                            dashboard=self.MAL_URL, scope=self.__oauth['sc2:fal'])
-        self.__identities['mal3'] = r['homeRegion']['baseUri']['content']
-        if ('mal-1a' in self.__identities['mal3']):
-            self.__identities['fal3'] = self.BASE_URL
+        region = {'mal': r['homeRegion']['baseUri']['content']}
+        if ('mal-1a' in region['mal']):
+            region['fal'] = self.BASE_URL
         else:
-            upr = urlparse(self.__identities['mal3'])
-            self.__identities['fal3'] = upr.scheme+'://' + \
+            upr = urlparse(region['mal'])
+            region['fal'] = upr.scheme+'://' + \
                 upr.netloc.replace('mal', 'fal')+'/fs-car'
-        logger.debug('fal3 URL = %s', self.__identities['fal3'])
+        region['timestamp'] = time.time()
+        self.__regions[vin] = region
+        logger.debug('fal3 URL = %s', region['fal'])
         logger.info('Received fal/mal Uri')
+        self.__save_regions()
+
+    def __save_regions(self):
+        atomic_write(self.__regions_file, json.dumps(self.__regions))
+        logger.info('Saving regions to file')
+
+    def __region_valid(self, vin):
+        region = self.__regions.get(vin)
+        return region and region['timestamp']+self.REGION_TTL >= time.time()
+
+    def __get_region(self, vin):
+        # Its own lock, a home region lookup never holds up the auth of others
+        if (not self.__region_valid(vin)):
+            with self.__regions_lock:
+                if (not self.__region_valid(vin)):
+                    with tracing.span('home-region'):
+                        self.__get_homeregion(vin)
+        return self.__regions[vin]
+
+    def __refresh_region(self, vin, dashboard, error):
+        # Returns the new fal url when a failed request went to a stale region
+        region = self.__regions.get(vin) if vin else None
+        if (not region or dashboard != region['fal']):
+            return None
+        if (isinstance(error, UrlError) and error.status_code != 404 and error.status_code < 500):
+            return None
+        logger.warning('Request to %s failed. Refreshing home region', dashboard)
+        try:
+            with self.__regions_lock:
+                self.__get_homeregion(vin)
+        except (VWError, requests.exceptions.RequestException):
+            logger.error('Failed to refresh home region')
+            return None
+        if (self.__regions[vin]['fal'] == dashboard):
+            return None
+        return self.__regions[vin]['fal']
+
+    def __discover_vins(self):
+        vins = []
+        try:
+            vins = [car['vehicleIdentificationNumber']
+                    for car in self.get_real_car_data().get('realCars', [])]
+        except (VWError, KeyError) as e:
+            logger.warning('Failed to get real car data: %s', e)
+        if (not vins):
+            vehicles = self.get_vehicles()['userVehicles']['vehicle']
+            vins = vehicles if isinstance(vehicles, list) else [vehicles]
+        logger.info('Discovered VINs: %s', ', '.join(vins))
+
+        with self.__vins_lock:
+            self.__vins = {'vins': vins, 'timestamp': time.time()}
+            atomic_write(self.__vins_file, json.dumps(self.__vins))
+        return vins
+
+    def __refresh_vins_in_background(self):
+        def refresh():
+            try:
+                self.__discover_vins()
+            except (VWError, requests.exceptions.RequestException) as e:
+                logger.error('Failed to refresh VINs: %s', e)
+
+        with self.__vins_lock:
+            if (self.__vins_refresh and self.__vins_refresh.is_alive()):
+                return
+            # A daemon, a pending refresh must not keep the worker alive
+            self.__vins_refresh = threading.Thread(
+                target=refresh, name='VinRefresh', daemon=True)
+            self.__vins_refresh.start()
+
+    def get_vins(self, refresh=False):
+        # VINs of the account. A stale list is still returned while it is
+        # refreshed in the background, refresh=True looks them up right away
+        with self.__vins_lock:
+            if (self.__vins is None):
+                try:
+                    with open(self.__vins_file, 'r') as f:
+                        self.__vins = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    pass
+            cached = self.__vins
+        if (refresh or not cached or not cached['vins']):
+            return self.__discover_vins()
+        if (cached['timestamp']+self.VINS_TTL < time.time()):
+            self.__refresh_vins_in_background()
+        return cached['vins']
 
     def __get_fal_url(self, vin):
-        if ('fal3' not in self.__identities):
-            self.__get_homeregion(vin)
-        return self.__identities['fal3']
+        return self.__get_region(vin)['fal']
 
     def __get_mal_url(self, vin):
-        if ('mal3' not in self.__identities):
-            self.__get_homeregion(vin)
-        return self.__identities['mal3']
+        return self.__get_region(vin)['mal']
 
     def set_brand_country(self, brand='VW', country='DE'):
         self.__brand = brand
@@ -536,6 +966,29 @@ class WeConnect():
     def set_logging_level(self, level):
         logger.setLevel(level)
 
+    @classmethod
+    def transport_stats(cls):
+        # Retry and circuit breaker counters of this process, for monitoring
+        stats = dict(cls.RETRY_POLICY.counters)
+        stats.update({'circuit_' + k: v for k, v in cls.CIRCUIT_BREAKER.counters.items()})
+        stats['open_circuits'] = cls.CIRCUIT_BREAKER.open_hosts()
+        return stats
+
+    def set_cache_ttl(self, ttl):
+        # Same TTL in seconds for every cached endpoint, 0 disables the cache
+        for endpoint in self.__cache_ttl:
+            self.__cache_ttl[endpoint] = ttl
+
+    def set_cassette(self, cassette):
+        # Records to or replays from a Cassette instead of the network
+        self.__cassette = cassette
+
+    def set_rate_limits(self, limits, max_wait=None):
+        # Requests per minute per endpoint family, 0 disables a limit
+        self.__rate_limiter.limits.update(limits)
+        if (max_wait is not None):
+            self.__rate_limiter.max_wait = max_wait
+
     def version(self):
         return _version.__version__
 
@@ -603,7 +1056,7 @@ class WeConnect():
 
     def get_vsr(self, vin):
         r = self.__command('/bs/vsr/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=self.__get_fal_url(
-            vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+            vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, cache='vsr')
         return r
 
     def get_departure_timer(self, vin):
@@ -613,7 +1066,7 @@ class WeConnect():
 
     def get_climater(self, vin):
         r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater',
-                           dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+                           dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, cache='climater')
         return r
 
     def get_position(self, vin):
@@ -628,12 +1081,12 @@ class WeConnect():
 
     def get_charger(self, vin):
         r = self.__command('/bs/batterycharge/v1/{brand}/{country}/vehicles/'+vin+'/charger',
-                           dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+                           dashboard=self.__get_fal_url(vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, cache='charger')
         return r
 
     def get_heating_status(self, vin):
         r = self.__command('/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/status', dashboard=self.__get_fal_url(
-            vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
+            vin), scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, cache='heating')
         return r
 
     def get_history(self, vin):
@@ -772,10 +1225,8 @@ class WeConnect():
             }
         }
 
-        secure_token = self.__request_secure_token(
-            vin, 'rclima_v1/operations/P_START_CLIMA_AU')
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
-            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, secure_token=secure_token)
+        r = self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
+            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
         return r
 
     def climatisation(self, vin, action='off'):
@@ -785,10 +1236,8 @@ class WeConnect():
             }
 
         }
-        secure_token = self.__request_secure_token(
-            vin, 'rclima_v1/operations/P_START_CLIMA_AU')
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
-            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, secure_token=secure_token)
+        r = self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
+            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
         return r
 
     def climatisation_temperature(self, vin, temperature=21.5):
@@ -804,10 +1253,8 @@ class WeConnect():
             }
 
         }
-        secure_token = self.__request_secure_token(
-            vin, 'rclima_v1/operations/P_START_CLIMA_AU')
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
-            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, secure_token=secure_token)
+        r = self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
+            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
         return r
 
     def window_melt(self, vin, action='off'):
@@ -817,10 +1264,8 @@ class WeConnect():
             }
 
         }
-        secure_token = self.__request_secure_token(
-            vin, 'rclima_v1/operations/P_START_CLIMA_AU')
-        r = self.__command('/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
-            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, secure_token=secure_token)
+        r = self.__secure_command(vin, 'rclima_v1/operations/P_START_CLIMA_AU', '/bs/climatisation/v1/{brand}/{country}/vehicles/'+vin+'/climater/actions', dashboard=self.__get_fal_url(
+            vin), post=data, scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb)
         return r
 
     def __generate_secure_pin(self, challenge):
@@ -833,7 +1278,48 @@ class WeConnect():
         logger.debug('spin = %s', spin)
         return spin
 
+    def __get_cached_secure_token(self, vin, service):
+        t = self.__secure_tokens.get(vin, {}).get(service)
+        if (t and t['timestamp']+self.SECURE_TOKEN_TTL > time.time()):
+            logger.debug('Using cached security token for %s', service)
+            return t['token']
+        return None
+
+    def __drop_secure_token(self, vin, service):
+        if (service in self.__secure_tokens.get(vin, {})):
+            self.__save_secure_token(vin, service, None)
+
+    def __save_secure_token(self, vin, service, token):
+        # The access file also holds the tokens, which another process may
+        # have refreshed since we loaded it, so reload before writing it back
+        with self.__auth_lock, FileLock(self.__lock_file):
+            self.__load_access()
+            services = self.__secure_tokens.setdefault(vin, {})
+            if (token):
+                services[service] = {'token': token, 'timestamp': time.time()}
+            else:
+                services.pop(service, None)
+            self.__save_access()
+
+    def __secure_command(self, vin, service, command, **kwargs):
+        secure_token = self.__get_cached_secure_token(vin, service)
+        if (not secure_token):
+            return self.__command(command, secure_token=self.__request_secure_token(vin, service), **kwargs)
+        try:
+            return self.__command(command, secure_token=secure_token, **kwargs)
+        except UrlError as e:
+            if (e.status_code not in (401, 403)):
+                raise
+            logger.info('Cached security token rejected. Requesting a new one')
+            self.__drop_secure_token(vin, service)
+            return self.__command(command, secure_token=self.__request_secure_token(vin, service), **kwargs)
+
     def __request_secure_token(self, vin, service):
+        metrics.SECURE_TOKENS.inc(account=self.account, vin=metrics.hashed(vin), service=service)
+        with tracing.span('secure-token', service=service):
+            return self.__authorize_secure_token(vin, service)
+
+    def __authorize_secure_token(self, vin, service):
         logger.info('Requesting secure token')
         r = self.__command('/rolesrights/authorization/v2/vehicles/'+vin+'/services/'+service +
                            '/security-pin-auth-requested', dashboard=self.MAL_URL, scope=self.__oauth['sc2:fal'])
@@ -856,6 +1342,7 @@ class WeConnect():
         logger.info('Completed security pin auth')
         if ('securityToken' in r):
             logger.info('Received security token')
+            self.__save_secure_token(vin, service, r['securityToken'])
             return r['securityToken']
         logger.error('No security token found')
         return None
@@ -866,10 +1353,8 @@ class WeConnect():
         else:
             data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<performAction xmlns="http://audi.de/connect/rs">\n   <quickstop>\n      <active>false</active>\n   </quickstop>\n</performAction>'
 
-        secure_token = self.__request_secure_token(
-            vin, 'rheating_v1/operations/P_QSACT')
-        r = self.__command('/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data,
-                           scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteStandheizung_v2_0_0+xml', secure_token=secure_token)
+        r = self.__secure_command(vin, 'rheating_v1/operations/P_QSACT', '/bs/rs/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data,
+                           scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteStandheizung_v2_0_0+xml')
         return r
 
     def lock(self, vin, action='lock'):
@@ -877,15 +1362,14 @@ class WeConnect():
             data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<rluAction xmlns="http://audi.de/connect/rlu">\n   <action>unlock</action>\n</rluAction>'
         else:
             data = '<?xml version="1.0" encoding= "UTF-8" ?>\n<rluAction xmlns="http://audi.de/connect/rlu">\n   <action>lock</action>\n</rluAction>'
-        secure_token = self.__request_secure_token(
-            vin, 'rlu_v1/operations/' + action.upper())
-        r = self.__command('/bs/rlu/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data,
-                           scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteLockUnlock_v1_0_0+xml', secure_token=secure_token)
+        r = self.__secure_command(vin, 'rlu_v1/operations/' + action.upper(), '/bs/rlu/v1/{brand}/{country}/vehicles/'+vin+'/actions', dashboard=self.BASE_URL, data=data,
+                           scope=self.__oauth['sc2:fal'], accept=self.__accept_mbb, content_type='application/vnd.vwg.mbb.RemoteLockUnlock_v1_0_0+xml')
         return r
 
-    def parse_vsr(self, j):
-        parser = VSR()
-        return parser.parse(j)
+    def parse_vsr(self, j, groups=None, fields=None, lazy=False):
+        with tracing.span('parse', document='vsr'):
+            parser = VSR()
+            return parser.parse(j, groups=groups, fields=fields, lazy=lazy)
 
     def pso(self, vin):
         r = self.__command('/bs/otv/v1/{brand}/{country}/vehicles/'+vin+'/configuration',
@@ -3,15 +3,29 @@ import sys
 
 
 def parseArguments():
-    if len(sys.argv) >= 4:
+    if len(sys.argv) >= 3 and sys.argv[2] == '--worker':
+        d = dict()
+        d['config'] = json_helpers.decode(sys.argv[1])
+        d['worker'] = True
+        d['batch'] = False
+        return d
+    elif len(sys.argv) >= 3 and sys.argv[2] == 'batch':
+        d = dict()
+        d['config'] = json_helpers.decode(sys.argv[1])
+        d['worker'] = False
+        d['batch'] = True
+        return d
+    elif len(sys.argv) >= 4:
         config = json_helpers.decode(sys.argv[1])
-        
+
         command = sys.argv[2]
         value = str(sys.argv[3])
         d = dict()
         d['config'] = config
         d['command'] = command
         d['value'] = value
+        d['worker'] = False
+        d['batch'] = False
         return d
     else:
         raise Exception("Received " + str(len(sys.argv)) +
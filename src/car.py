@@ -3,89 +3,232 @@ import os
 import logging
 import json_helpers
 import time
-
-from NativeAPI import WeConnect, VWError
-from credentials import Credentials
+import threading
+import tracing
+import metrics
+
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from NativeAPI import VWError, UrlError
+from session_pool import SessionPool
 from car_state import CarState
 from car_states import CarStates
+from state_store import JsonStateStore
+
+LOCK_FIELDS = ['lock_left_front', 'lock_right_front',
+               'lock_left_rear', 'lock_right_rear', 'lock_trunk']
+
+
+# Error codes of VW for a VIN that is not (or no longer) in the account
+VEHICLE_NOT_FOUND_CODES = ('mbbc.rolesandrights.unknownVehicle',
+                           'mbbc.rolesandrights.vehicleNotFound')
+
+
+def isVehicleNotFound(error):
+    return isinstance(error, UrlError) and error.error_code in VEHICLE_NOT_FOUND_CODES
 
 
 class Car:
-    def __init__(self, logger):
+    def __init__(self, logger, store=None, pool=None):
         self.logger = logger
+        self.store = store if store is not None else JsonStateStore(logger)
         self.carStates = self.getCarStates()
+        self.lastVsr = {}
+        self.pool = pool if pool is not None else SessionPool(1)
+        self.persistLock = threading.Lock()
+        self.vinLocks = {}
 
-    def executeCommand(self, config, command, value):
-        credentials = Credentials(
-            config['username'], config['password'], config['spin'])
-        vwc = WeConnect(credentials)
+    def getCredentials(self, config):
+        return (config['username'], config['password'], config['spin'])
+
+    def getConnection(self, config):
+        # Reuses the logged in session of the account if it is still pooled
+        vwc = self.pool.get(self.getCredentials(config))
         vwc.set_logging_level(self.logger.level)
+        if ('cacheTtl' in config):
+            vwc.set_cache_ttl(config['cacheTtl'])
+        if ('rateLimits' in config or 'rateLimitMaxWait' in config):
+            vwc.set_rate_limits(config.get('rateLimits', {}),
+                                config.get('rateLimitMaxWait'))
         vwc.login()
+        return vwc
+
+    def executeCommand(self, config, command, value):
+        with tracing.span('command', command=command or 'all', value=value):
+            vin = config.get('vin', '')
+            try:
+                vwc = self.getConnection(config)
+
+                vin = self.getVin(config, vwc)
+                try:
+                    return self.runCommand(config, vwc, vin, command, value)
+                except VWError as e:
+                    if config.get('vin') or not isVehicleNotFound(e):
+                        raise
+                    # The discovered car may have left the account since, look again
+                    self.logger.warning('Vehicle ' + vin + ' not found, refreshing VINs')
+                    newVin = self.getVin(config, vwc, refresh=True)
+                    if newVin == vin:
+                        raise
+                    return self.runCommand(config, vwc, newVin, command, value)
+            except Exception as e:
+                self.countError(config, vin, e)
+                raise
+
+    def countError(self, config, vin, error):
+        # The account label is the same hash WeConnect.account uses
+        metrics.ERRORS.inc(account=metrics.hashed(config['username']),
+                           vin=metrics.hashed(vin), type=type(error).__name__)
+
+    def vinLock(self, vin):
+        # Commands on the same car run one after the other in the worker
+        with self.persistLock:
+            return self.vinLocks.setdefault(vin, threading.RLock())
+
+    def addCarState(self, vin):
+        # Under the persist lock, the store iterates carStates while saving
+        with self.persistLock:
+            if vin not in self.carStates:
+                self.carStates[vin] = CarState()
 
-        vin = self.getVin(config, vwc)
+    def runCommand(self, config, vwc, vin, command, value):
+        with self.vinLock(vin):
+            return self.__runCommand(config, vwc, vin, command, value)
+
+    def __runCommand(self, config, vwc, vin, command, value):
+        previous = self.carStates[vin].snapshot()
 
         self.logger.debug(command)
         if (command == ''):  # Get status of everything
-            self.setLockedStatus(vwc, vin)
-            self.setClimatisationStatus(vwc, vin)
-            self.setChargingStatus(vwc, vin)
+            self.setStatus(vwc, vin)
         elif command == 'locked':
             self.setLockedStatus(vwc, vin)
-            self.updateLocked(vwc, vin, value)
         elif command == 'charging':
             self.setChargingStatus(vwc, vin)
+        elif command == 'climatisation' or command == 'window-heating':
+            self.setClimatisationStatus(vwc, vin)
+        else:
+            raise Exception('Unknown command')
+
+        self.recordStatus(vwc, vin)
+
+        if command == 'locked':
+            self.updateLocked(vwc, vin, value)
+        elif command == 'charging':
             self.updateCharging(vwc, vin, value)
         elif command == 'climatisation':
-            self.setClimatisationStatus(vwc, vin)
             self.updateClimatisation(vwc, vin, config, value)
             if config['combineHeating']:
                 self.updateWindowHeating(vwc, vin, value)
         elif command == 'window-heating':
-            self.setClimatisationStatus(vwc, vin)
             self.updateWindowHeating(vwc, vin, value)
-        else:
-            raise Exception('Unknown command')
 
-        print(json_helpers.to_json(self.carStates[vin], unpicklable=False))
-        self.persistCarStates()
+        changes = self.carStates[vin].diff(previous)
+        if changes:
+            self.logger.info('Changed: ' + ', '.join(
+                '{} {} -> {}'.format(field, old, new) for field, (old, new) in changes.items()))
+
+        self.persistCarStates([vin])
+        return self.carStates[vin]
 
-    def persistCarStates(self):
-        with open('carStates.json', 'w', buffering=1) as outfile:
-            outfile.write(json_helpers.to_json(
-                self.carStates, unpicklable=True))
+    def batchStatus(self, config):
+        # Yields (vin, state, error) for every car of the account as soon as
+        # its status is fetched, at most batchConcurrency cars at a time
+        vwc = self.getConnection(config)
+        vins = vwc.get_vins()
+        for vin in vins:
+            self.addCarState(vin)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, config.get('batchConcurrency', 4))) as executor:
+                futures = {executor.submit(self.fetchStatus, vwc, vin): vin for vin in vins}
+                for future in as_completed(futures):
+                    vin = futures[future]
+                    try:
+                        yield vin, future.result(), None
+                    except Exception as e:
+                        self.logger.error('Failed to get status of ' + vin + ': ' + str(e))
+                        self.countError(config, vin, e)
+                        yield vin, None, e
+        finally:
+            self.persistCarStates(vins)
+
+    def fetchStatus(self, vwc, vin):
+        # One trace per car, they are fetched side by side
+        with tracing.span('command', command='batch'), self.vinLock(vin):
+            self.setStatus(vwc, vin)
+            self.recordStatus(vwc, vin)
+            return self.carStates[vin]
+
+    def persistCarStates(self, vins):
+        # Saves only the cars of this command, each one under its lock so that
+        # no other command is halfway through changing it. Sorted to never
+        # deadlock with a batch holding the same locks.
+        with ExitStack() as stack:
+            for vin in sorted(set(vins)):
+                stack.enter_context(self.vinLock(vin))
+            with tracing.span('persist'), self.persistLock:
+                self.store.save(self.carStates, vins)
 
     def getCarStates(self) -> CarStates:
-        if not os.path.isfile('carStates.json'):
-            f = open('carStates.json', 'x')
-            f.close()
-            return CarStates()
+        return self.store.load()
 
-        with open('carStates.json', 'r', buffering=1) as outfile:
-            try:
-                return CarStates(json_helpers.from_json(CarStates, outfile.read()))
-            except:
-                return CarStates()
+    def recordStatus(self, vwc, vin):
+        if not self.store.keepsHistory:
+            return
+        with tracing.span('persist', history=True):
+            self.store.record(vin, self.carStates[vin], self.lastVsr.pop(vin, None))
 
-    def getVin(self, config, vwc):
+    def getVin(self, config, vwc, refresh=False):
         vin = ""
         
         if ('vin' in config):
             vin = config['vin']
         
         if len(vin) == 0:
-            vin = vwc.get_real_car_data(
-            )['realCars'][0]['vehicleIdentificationNumber']
+            vin = vwc.get_vins(refresh)[0]
 
-            if vin not in self.carStates:
-                self.carStates[vin] = CarState()
+            self.addCarState(vin)
 
             self.logger.info('VIN: ' + vin)
-        elif vin not in self.carStates:
-            self.carStates[vin] = CarState()
+        else:
+            self.addCarState(vin)
 
         return vin
 
+    def setStatus(self, vwc, vin):
+        # Every status lives behind its own endpoint, so fetch them side by side
+        getters = [self.getLockedStatus,
+                   self.getClimatisationStatus, self.getChargingStatus]
+        with ThreadPoolExecutor(max_workers=len(getters)) as executor:
+            futures = [executor.submit(tracing.bind(getter), vwc, vin) for getter in getters]
+
+        errors = []
+        for future in futures:
+            try:
+                self.updateCarState(vin, future.result())
+            except Exception as e:
+                self.logger.error('Failed to get status: ' + str(e))
+                errors.append(e)
+
+        # Partial results are fine, only fail when nothing could be fetched
+        if len(errors) == len(futures):
+            raise errors[0]
+
+    def updateCarState(self, vin, status):
+        for field, value in status.items():
+            setattr(self.carStates[vin], field, value)
+
     def setClimatisationStatus(self, vwc, vin):
+        self.updateCarState(vin, self.getClimatisationStatus(vwc, vin))
+
+    def setLockedStatus(self, vwc, vin):
+        self.updateCarState(vin, self.getLockedStatus(vwc, vin))
+
+    def setChargingStatus(self, vwc, vin):
+        self.updateCarState(vin, self.getChargingStatus(vwc, vin))
+
+    def getClimatisationStatus(self, vwc, vin):
         climaterStatus = vwc.get_climater(vin)['climater']['status']
 
         climatisation = False
@@ -103,31 +246,33 @@ class Car:
         except:
             pass
 
-        self.carStates[vin].windowHeating = windowHeating
-        self.carStates[vin].climatisation = climatisation
-
         self.logger.debug('Climater status: ' +
                           json_helpers.to_json(climaterStatus, unpicklable=False))
 
-    def setLockedStatus(self, vwc, vin):
+        return {'climatisation': climatisation, 'windowHeating': windowHeating}
+
+    def getLockedStatus(self, vwc, vin):
         vsr = vwc.get_vsr(vin)
-        pvsr = vwc.parse_vsr(vsr)
-        doors = pvsr.get('doors', [])
-        avdoors = {'left_front': 'Left front', 'right_front': 'Right front',
-                   'left_rear': 'Left rear', 'right_rear': 'Right rear', 'trunk': 'Trunk'}
+        if self.store.keepsHistory:
+            # The history keeps the whole parsed VSR, so parse it only once
+            pvsr = vwc.parse_vsr(vsr)
+            self.lastVsr[vin] = pvsr
+        else:
+            # Only the lock state of the doors is needed, skip the rest of the VSR
+            pvsr = vwc.parse_vsr(vsr, fields=LOCK_FIELDS)
+        doors = pvsr.get('doors', {})
 
         self.logger.debug('Doors status: ' +
                           json_helpers.to_json(doors, unpicklable=False))
 
-        for d in avdoors.items():
-            locked = doors.get('lock_'+d[0], '')
+        for field in LOCK_FIELDS:
+            locked = doors.get(field, '')
             if (locked != 'locked'):
-                self.carStates[vin].locked = False
-                return
+                return {'locked': False}
 
-        self.carStates[vin].locked = True
+        return {'locked': True}
 
-    def setChargingStatus(self, vwc, vin):
+    def getChargingStatus(self, vwc, vin):
         chargerStatus = vwc.get_charger(vin)['charger']['status']
         charging = chargerStatus['chargingStatusData']['chargingState']['content'] != 'off'
         batteryLevel = chargerStatus['batteryStatusData']['stateOfCharge']['content']
@@ -135,8 +280,7 @@ class Car:
         self.logger.debug('Charging status: ' +
                           json_helpers.to_json(chargerStatus, unpicklable=False))
 
-        self.carStates[vin].charging = charging
-        self.carStates[vin].batteryLevel = batteryLevel
+        return {'charging': charging, 'batteryLevel': batteryLevel}
 
     def updateLocked(self, vwc, vin, value):
         if value == '1':
@@ -1,10 +1,47 @@
 class CarState:
-    climatisation = None
-    locked = None
+    """
+    Latest known state of one car. Assigning a field marks it dirty until
+    markClean() is called, even when the value did not change: it was just
+    fetched, so it wins over whatever another process saved meanwhile.
+    isDirty() only tells whether a value differs from the last one loaded or
+    saved, so persistence can skip cars that did not change.
+    """
+
+    FIELDS = ('climatisation', 'windowHeating', 'locked', 'batteryLevel', 'charging')
+
+    __slots__ = FIELDS + ('_dirty', '_synced')
 
     def __init__(self, climatisation: int = None, windowHeating: int = None, locked: int = None, batteryLevel: int = None, charging: int = None):
-        self.climatisation = climatisation
-        self.windowHeating = windowHeating
-        self.locked = locked
-        self.batteryLevel = batteryLevel
-        self.charging = charging
+        object.__setattr__(self, '_dirty', set())
+        object.__setattr__(self, 'climatisation', climatisation)
+        object.__setattr__(self, 'windowHeating', windowHeating)
+        object.__setattr__(self, 'locked', locked)
+        object.__setattr__(self, 'batteryLevel', batteryLevel)
+        object.__setattr__(self, 'charging', charging)
+        object.__setattr__(self, '_synced', self.snapshot())
+
+    def __setattr__(self, name, value):
+        if name in CarState.FIELDS:
+            # jsonpickle restores instances without calling __init__
+            if not hasattr(self, '_dirty'):
+                object.__setattr__(self, '_dirty', set())
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    def isDirty(self) -> bool:
+        # jsonpickle restored instances were never synced
+        return self.snapshot() != getattr(self, '_synced', None)
+
+    def dirtyFields(self) -> frozenset:
+        return frozenset(self._dirty)
+
+    def markClean(self):
+        self._dirty.clear()
+        object.__setattr__(self, '_synced', self.snapshot())
+
+    def snapshot(self) -> tuple:
+        return (self.climatisation, self.windowHeating, self.locked, self.batteryLevel, self.charging)
+
+    def diff(self, previous: tuple) -> dict:
+        # Fields that differ from a snapshot(), as field: (old, new)
+        return {field: (old, new) for field, old, new in zip(CarState.FIELDS, previous, self.snapshot()) if old != new}
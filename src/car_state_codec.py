@@ -0,0 +1,44 @@
+import json
+
+from car_state import CarState
+from car_states import CarStates
+
+# Bump when the layout written by dumps changes and migrate in loads
+VERSION = 1
+
+
+def encode_state(state: CarState) -> dict:
+    return {
+        'climatisation': state.climatisation,
+        'windowHeating': state.windowHeating,
+        'locked': state.locked,
+        'batteryLevel': state.batteryLevel,
+        'charging': state.charging,
+    }
+
+
+def decode_state(d: dict) -> CarState:
+    return CarState(
+        climatisation=d.get('climatisation'),
+        windowHeating=d.get('windowHeating'),
+        locked=d.get('locked'),
+        batteryLevel=d.get('batteryLevel'),
+        charging=d.get('charging'),
+    )
+
+
+def dumps(carStates: CarStates) -> str:
+    cars = {vin: encode_state(state) for vin, state in carStates.items()}
+    return json.dumps({'version': VERSION, 'cars': cars})
+
+
+def loads(text: str) -> CarStates:
+    data = json.loads(text)
+
+    if isinstance(data.get('version'), int) and isinstance(data.get('cars'), dict):
+        cars = data['cars']
+    else:
+        # Written by jsonpickle: {vin: {"py/object": "car_state.CarState", ...}}
+        cars = data
+
+    return CarStates({vin: decode_state(d) for vin, d in cars.items()})
@@ -0,0 +1,217 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import requests
+
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from requests.structures import CaseInsensitiveDict
+from file_helpers import atomic_write
+
+logger = logging.getLogger('Cassette')
+
+SCRUBBED = 'SCRUBBED'
+# Request fields, response keys and query parameters never written to a
+# cassette. Tokens are also scrubbed wherever they show up again as a whole
+# value, credentials and personal data (often plain words) only at their key.
+SECRET_KEYS = {'access_token', 'refresh_token', 'id_token', 'code', 'auth_code',
+               'code_verifier', 'token', 'securitytoken', 'client_secret',
+               'hmac', '_csrf', 'csrf_token'}
+PRIVATE_KEYS = {'password', 'email', 'securitypinhash', 'firstname', 'lastname',
+                'nickname', 'dateofbirth', 'birthdate'}
+KEPT_HEADERS = ('Content-Type', 'Location', 'ETag', 'Last-Modified', 'Retry-After')
+
+# Hidden login form fields and the window._IDK object of the login pages
+HTML_INPUT = re.compile(r'<input\b[^>]*>', re.I)
+HTML_ATTRIBUTE = re.compile(r'\b(name|value)\s*=\s*"([^"]*)"', re.I)
+IDK_VALUE = re.compile(r'(["\']?)(\w+)\1(\s*:\s*)(["\'])((?:(?!\4).)*)\4')
+
+
+class CassetteError(Exception):
+    pass
+
+
+class Cassette:
+    """
+    Records the requests of WeConnect.__get_url and their responses to a JSON
+    file, or replays them without touching the network.
+
+    Credentials, tokens and personal data are replaced with SCRUBBED in
+    query parameters, form fields, JSON keys and the login pages before
+    anything is written, every interaction again on each write so that a
+    token first seen later is not left behind in earlier ones. Replay matches
+    on method, host and path, in recorded order, and raises CassetteError
+    for a request that was not recorded, so an extra round trip fails.
+
+    WECONNECT_CASSETTE=<file> with WECONNECT_CASSETTE_MODE=record|replay and
+    WECONNECT_CASSETTE_LATENCY=<seconds> enables it for every WeConnect.
+    """
+
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    __shared = None
+
+    def __init__(self, path, mode=REPLAY, latency=0):
+        if (mode not in (Cassette.RECORD, Cassette.REPLAY)):
+            raise ValueError('Unknown cassette mode: ' + mode)
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.__lock = threading.Lock()
+        self.__secrets = set()
+        self.__recorded = []
+        self.__interactions = []
+        self.__queues = {}
+        if (mode == Cassette.REPLAY):
+            with open(path, 'r') as f:
+                self.__interactions = json.load(f)['interactions']
+            for interaction in self.__interactions:
+                request = interaction['request']
+                self.__queues.setdefault(self.__key(request['method'], request['url']), []).append(interaction)
+
+    @classmethod
+    def from_environment(cls):
+        # One cassette per process, shared by every WeConnect
+        path = os.environ.get('WECONNECT_CASSETTE')
+        if (not path):
+            return None
+        if (cls.__shared is None or cls.__shared.path != path):
+            cls.__shared = Cassette(path, os.environ.get('WECONNECT_CASSETTE_MODE', Cassette.REPLAY),
+                                    float(os.environ.get('WECONNECT_CASSETTE_LATENCY', 0)))
+        return cls.__shared
+
+    @property
+    def replaying(self):
+        return self.mode == Cassette.REPLAY
+
+    def __key(self, method, url):
+        u = urlparse(url)
+        return method + ' ' + u.scheme + '://' + u.netloc + u.path
+
+    def __secret(self, key, value):
+        if (key.lower() in SECRET_KEYS and isinstance(value, str) and value and value != SCRUBBED):
+            self.__secrets.add(value)
+        return SCRUBBED
+
+    def __scrubbed(self, key, value):
+        # Whether the value at key (None for a list item) is never written
+        return ((key is not None and key.lower() in SECRET_KEYS | PRIVATE_KEYS) or
+                (isinstance(value, str) and value in self.__secrets))
+
+    def __scrub_pairs(self, pairs):
+        return [(k, self.__secret(k, v) if self.__scrubbed(k, v) else v) for k, v in pairs]
+
+    def __scrub_url(self, url):
+        u = urlparse(url)
+        query = urlencode(self.__scrub_pairs(parse_qsl(u.query, keep_blank_values=True)))
+        fragment = urlencode(self.__scrub_pairs(parse_qsl(u.fragment, keep_blank_values=True)))
+        return urlunparse(u._replace(query=query, fragment=fragment))
+
+    def __scrub_data(self, data, key=None):
+        if (isinstance(data, dict)):
+            return {k: self.__scrub_data(v, k) for k, v in data.items()}
+        if (isinstance(data, list)):
+            return [self.__scrub_data(v) for v in data]
+        if (self.__scrubbed(key, data)):
+            return self.__secret(key or '', data)
+        return data
+
+    def __scrub_input(self, match):
+        tag = match.group(0)
+        attributes = {k.lower(): v for k, v in HTML_ATTRIBUTE.findall(tag)}
+        if ('value' not in attributes or not self.__scrubbed(attributes.get('name', ''), attributes['value'])):
+            return tag
+        self.__secret(attributes.get('name', ''), attributes['value'])
+        return HTML_ATTRIBUTE.sub(lambda m: m.group(0) if m.group(1).lower() != 'value'
+                                  else m.group(1) + '="' + SCRUBBED + '"', tag)
+
+    def __scrub_idk(self, match):
+        quote, key, colon, value_quote, value = match.groups()
+        if (not self.__scrubbed(key, value)):
+            return match.group(0)
+        self.__secret(key, value)
+        return quote + key + quote + colon + value_quote + SCRUBBED + value_quote
+
+    def __scrub_body(self, content):
+        try:
+            return json.dumps(self.__scrub_data(json.loads(content)))
+        except ValueError:
+            pass
+        return IDK_VALUE.sub(self.__scrub_idk, HTML_INPUT.sub(self.__scrub_input, content))
+
+    def __scrub(self, interaction):
+        request, response = interaction['request'], interaction['response']
+        headers = dict(response['headers'])
+        if ('Location' in headers):
+            headers['Location'] = self.__scrub_url(headers['Location'])
+        return {
+            'request': {'method': request['method'], 'url': self.__scrub_url(request['url']),
+                        'body': self.__scrub_data(request['body'])},
+            'response': {
+                'status': response['status'],
+                'url': self.__scrub_url(response['url']),
+                'headers': headers,
+                'history': [self.__scrub_url(url) for url in response['history']],
+                'body': self.__scrub_body(response['body']),
+            },
+        }
+
+    def record(self, method, url, params, data, headers, response):
+        with self.__lock:
+            for name in ('Authorization', 'X-MBBSecToken'):
+                if (headers and headers.get(name)):
+                    self.__secret('token', headers[name].split(' ')[-1])
+            # The login's CarNetAdapter response has no body
+            content = getattr(response, 'content', None) or b''
+            if (isinstance(content, bytes)):
+                content = content.decode('utf-8', 'replace')
+            self.__recorded.append({
+                'request': {'method': method, 'url': requests.Request(method, url, params=params).prepare().url,
+                            'body': data},
+                'response': {
+                    'status': response.status_code,
+                    'url': response.url,
+                    'headers': {k: response.headers[k] for k in KEPT_HEADERS
+                                if response.headers and k in response.headers},
+                    'history': [h.url for h in (response.history or [])],
+                    'body': content,
+                },
+            })
+            # The first pass learns the tokens of every interaction, the
+            # second one scrubs them wherever they were seen before
+            for _ in range(2):
+                self.__interactions = [self.__scrub(interaction) for interaction in self.__recorded]
+            atomic_write(self.path, json.dumps({'interactions': self.__interactions}, indent=1))
+
+    def replay(self, method, url, params):
+        request = requests.Request(method, url, params=params).prepare()
+        key = self.__key(method, request.url)
+        with self.__lock:
+            queue = self.__queues.get(key)
+            if (not queue):
+                raise CassetteError('Request not in cassette: ' + key)
+            interaction = queue.pop(0)
+        if (self.latency):
+            time.sleep(self.latency)
+
+        saved = interaction['response']
+        r = self.__response(saved['status'], saved['url'], saved['headers'], saved['body'], request)
+        r.history = [self.__response(302, h, {}, '', request) for h in saved['history']]
+        return r
+
+    def __response(self, status, url, headers, body, request):
+        r = requests.Response()
+        r.status_code = status
+        r.url = url
+        r.headers = CaseInsensitiveDict(headers)
+        r._content = body.encode('utf-8')
+        r.encoding = 'utf-8'
+        r.request = request
+        u = urlparse(url)
+        if (u.scheme == 'carnet'):
+            # CarNetAdapter exposes the redirect parameters of the login
+            r.params = dict(parse_qsl(u.fragment or u.query))
+        return r
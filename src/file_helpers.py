@@ -0,0 +1,42 @@
+import os
+import fcntl
+import tempfile
+
+
+def atomic_write(path, content, mode='w'):
+    # Readers see either the old or the new file, never a partial write
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+class FileLock:
+    """
+    Advisory lock on a file shared by every process on the machine,
+    used as a context manager. The lock file itself is never removed.
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.__file = None
+
+    def __enter__(self):
+        self.__file = open(self.path, 'a')
+        fcntl.flock(self.__file.fileno(),
+                    fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+        self.__file.close()
+        self.__file = None
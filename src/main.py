@@ -2,11 +2,17 @@
 import sys
 import os
 import logging
+import json
+import car_state_codec
+import tracing
+import metrics
 
 from arguments_parser import parseArguments
 from car import Car
-
-from NativeAPI import VWError
+from session_pool import SessionPool
+from state_store import createStateStore
+from worker import Worker, errorMessage, batchLine
+from retry_policy import deadline
 
 # Ensure working directory is same as this files location
 if os.path.dirname(sys.argv[0]):
@@ -28,13 +34,31 @@ try:
     loggingLevel = arguments['config']['loggingLevel']
     logger.setLevel(loggingLevel)
 
-    car = Car(logger)
-    car.executeCommand(arguments['config'],
-                       arguments['command'], arguments['value'])
-except VWError as e:
-    if 'login.error' in e.message:
-        logger.error('VWError: Failed to login')
+    config = arguments['config']
+    if 'trace' in config:
+        tracing.configure(config['trace'], config.get('traceFile'))
+    store = createStateStore(config, logger)
+    if arguments['worker']:
+        # Keep serving requests from stdin until the plugin closes it
+        pool = SessionPool(config.get('maxSessions', 16),
+                           config.get('tokenRefreshMargin', 300),
+                           config.get('tokenRefreshJitter', 60))
+        metricsServer = metrics.serve(config.get('metricsPort'), config.get('metricsSocket'))
+        try:
+            Worker(Car(logger, store, pool), config, logger).run()
+        finally:
+            if metricsServer:
+                metricsServer.shutdown()
+                metricsServer.server_close()
+    elif arguments['batch']:
+        # One line per car, in the order they complete
+        for vin, carState, error in Car(logger, store).batchStatus(config):
+            print(json.dumps(batchLine(vin, carState, error)), flush=True)
     else:
-        logger.error('VWError: ' + e.message)
+        car = Car(logger, store)
+        with deadline(config.get('requestTimeout', 10)):
+            carState = car.executeCommand(config,
+                                          arguments['command'], arguments['value'])
+        print(json.dumps(car_state_codec.encode_state(carState)))
 except Exception as e:
-    logger.error('Fatal Error: ' + str(e))
+    logger.error(errorMessage(e))
@@ -0,0 +1,193 @@
+import os
+import re
+import stat
+import hashlib
+import logging
+import threading
+import socketserver
+
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('Metrics')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def hashed(value):
+    # VINs and usernames never appear in labels, only a short hash of them
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:12] if value else ''
+
+
+def endpoint(url):
+    # Host and path, with VINs, user ids and client ids replaced by :id
+    u = urlparse(url)
+    return u.netloc + '/'.join(':id' if (len(segment) >= 8 and re.search(r'\d', segment)) else segment
+                               for segment in u.path.split('/'))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    if (labels):
+        name += '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+    return '{} {}'.format(name, value)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self, key, value):
+        return [_sample(self.name, key, value)]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            buckets, total, count = self._values.get(key, ((0,) * len(self.BUCKETS), 0, 0))
+            buckets = tuple(b + (value <= bound) for b, bound in zip(buckets, self.BUCKETS))
+            self._values[key] = (buckets, total + value, count + 1)
+
+    def _samples(self, key, value):
+        buckets, total, count = value
+        samples = [_sample(self.name + '_bucket', key + (('le', str(bound)),), b)
+                   for bound, b in zip(self.BUCKETS, buckets)]
+        samples.append(_sample(self.name + '_bucket', key + (('le', '+Inf'),), count))
+        samples.append(_sample(self.name + '_sum', key, round(total, 6)))
+        samples.append(_sample(self.name + '_count', key, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self.__add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=()):
+        return self.__add(Histogram(name, help, labels))
+
+    def __add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return ''.join(line + '\n' for metric in self.metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'weconnect_request_duration_seconds', 'Latency of requests to VW, retries included',
+    ('account', 'vin', 'endpoint', 'method'))
+REQUESTS = REGISTRY.counter(
+    'weconnect_requests_total', 'Requests to VW by response status, error when there was none',
+    ('account', 'vin', 'endpoint', 'method', 'status'))
+RETRIES = REGISTRY.counter(
+    'weconnect_retries_total', 'Requests to VW sent again, by status or exception of the failed attempt',
+    ('account', 'endpoint', 'reason'))
+CACHE = REGISTRY.counter(
+    'weconnect_cache_total', 'Cacheable status reads: hit, miss, coalesced, stale (served while rate limited) or not_modified',
+    ('account', 'vin', 'endpoint', 'result'))
+AUTH = REGISTRY.counter(
+    'weconnect_auth_total', 'Token refreshes and forced logins',
+    ('account', 'kind'))
+SECURE_TOKENS = REGISTRY.counter(
+    'weconnect_secure_token_requests_total', 'Security PIN authorizations for remote actions',
+    ('account', 'vin', 'service'))
+ERRORS = REGISTRY.counter(
+    'weconnect_errors_total', 'Failed commands by exception type',
+    ('account', 'vin', 'type'))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if (self.path.split('?')[0] not in ('/', '/metrics')):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def serve(port=None, path=None, host='127.0.0.1'):
+    """
+    Serves the metrics in the Prometheus text format on a local port or a
+    Unix socket from a background thread. Returns the server, or None when
+    neither is configured or it can not be bound.
+    """
+    try:
+        if (path):
+            # Only a socket left behind by an earlier run, never another file
+            try:
+                if (stat.S_ISSOCK(os.stat(path).st_mode)):
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+            server = UnixHTTPServer(path, MetricsHandler)
+            where = path
+        elif (port):
+            server = ThreadingHTTPServer((host, port), MetricsHandler)
+            server.daemon_threads = True
+            where = '{}:{}'.format(host, server.server_address[1])
+        else:
+            return None
+    except OSError as e:
+        logger.warning('Not serving metrics on %s: %s', path or port, e)
+        return None
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    logger.info('Serving metrics on %s', where)
+    return server
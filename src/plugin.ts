@@ -9,8 +9,7 @@ import {
 } from "homebridge";
 
 import timeoutPromise from "./timeoutPromise";
-import { join } from "path";
-import { spawn } from "child_process";
+import PythonWorker from "./pythonWorker";
 
 const packageJson = require("../package.json");
 
@@ -45,6 +44,7 @@ class WeConnect implements AccessoryPlugin {
     private batteryLevel = 0;
 
     private getStatusPromise: Promise<void> | undefined = undefined;
+    private readonly worker: PythonWorker;
 
     private readonly services: Service[] = [];
     private readonly climatisationService: Service;
@@ -76,6 +76,11 @@ class WeConnect implements AccessoryPlugin {
         this.model = config["model"] || packageJson["name"];
         this.serial = config["serial"] || packageJson["version"];
 
+        this.worker = new PythonWorker(log, config);
+        api.on("shutdown", () => {
+            this.worker.stop();
+        });
+
         this.climatisationService = new hap.Service.Fan(
             this.name,
             "Climatisation"
@@ -535,63 +540,36 @@ class WeConnect implements AccessoryPlugin {
     }
 
     async setCurrentState(command: string, value: string): Promise<void> {
-        let python = spawn(join(__dirname, "/venv/bin/python3"), [
-            join(__dirname, "main.py"),
-            JSON.stringify(this.config),
-            command,
-            value,
-        ]);
-
-        let success = false;
-        let error: string | undefined = undefined;
-        let currentState = false;
-
-        python.stderr.on("data", (data) => {
-            error = data;
-            // logging from python is retrieved by stderr, so error can either be error or just logging info
-            this.log("Python: " + error);
-        });
-
-        python.stdout.on("data", (data) => {
-            this.log.debug(data);
-            let parsed = JSON.parse(data);
-            if (command == "climatisation") {
-                currentState = this.combineHeating
-                    ? parsed.climatisation && parsed.windowHeating
-                    : parsed.climatisation;
-            } else if (command == "window-heating") {
-                currentState = parsed.windowHeating;
-            } else if (command == "locked") {
-                currentState = parsed.locked;
-            } else if (command == "charging") {
-                currentState = parsed.charging;
-            }
-
-            if (value == "1" && currentState) {
-                success = true;
-            } else if (value == "0" && !currentState) {
-                success = true;
-            } else {
-                this.log.error(
-                    `Python error due to: Current State ${currentState} and Set Value ${value}`
-                );
-            }
-        });
-
         return timeoutPromise(
-            new Promise((resolve, reject) => {
-                python.on("close", (code) => {
-                    if (success) {
-                        // Force refresh with get status
-                        this.lastStatusRequest = undefined;
-                        resolve();
+            this.worker.request(command, value).then((parsed) => {
+                this.log.debug(JSON.stringify(parsed));
+                let currentState = false;
+                if (command == "climatisation") {
+                    currentState = this.combineHeating
+                        ? parsed.climatisation && parsed.windowHeating
+                        : parsed.climatisation;
+                } else if (command == "window-heating") {
+                    currentState = parsed.windowHeating;
+                } else if (command == "locked") {
+                    currentState = parsed.locked;
+                } else if (command == "charging") {
+                    currentState = parsed.charging;
+                }
 
-                        // Polls the car every 10 seconds to see if the queued action was succesfully handled.
-                        this.validateSetAction(command, value, 10000, 3);
-                    } else {
-                        reject(new Error(error));
-                    }
-                });
+                if (
+                    (value == "1" && currentState) ||
+                    (value == "0" && !currentState)
+                ) {
+                    // Force refresh with get status
+                    this.lastStatusRequest = undefined;
+
+                    // Polls the car every 10 seconds to see if the queued action was succesfully handled.
+                    this.validateSetAction(command, value, 10000, 3);
+                } else {
+                    const error = `Python error due to: Current State ${currentState} and Set Value ${value}`;
+                    this.log.error(error);
+                    throw new Error(error);
+                }
             }),
             10000,
             new Error(`Timed out setting state of ${command} to ${value}`)
@@ -739,25 +717,8 @@ class WeConnect implements AccessoryPlugin {
     }
 
     async getCurrentState(command: string = ""): Promise<void> {
-        let python = spawn(join(__dirname, "/venv/bin/python3"), [
-            join(__dirname, "main.py"),
-            JSON.stringify(this.config),
-            command,
-            "status",
-        ]);
-
-        let success = false;
-        let error: string | undefined = undefined;
-
-        python.stderr.on("data", (data) => {
-            error = data;
-            // logging from python is retrieved by stderr, so error can either be error or just logging info
-            this.log("Python: " + error);
-        });
-
-        python.stdout.on("data", (data) => {
-            try {
-                let parsed = JSON.parse(data);
+        return timeoutPromise(
+            this.worker.request(command, "status").then((parsed) => {
                 this.climatisationOn = this.combineHeating
                     ? parsed.climatisation && parsed.windowHeating
                     : parsed.climatisation;
@@ -765,23 +726,6 @@ class WeConnect implements AccessoryPlugin {
                 this.locked = parsed.locked;
                 this.charging = parsed.charging;
                 this.batteryLevel = parsed.batteryLevel;
-                success = true;
-            } catch (dataError) {
-                this.log.error(
-                    `Get current state on data received: ${data} with error: ${dataError}`
-                );
-            }
-        });
-
-        return timeoutPromise(
-            new Promise((resolve, reject) => {
-                python.on("close", (code) => {
-                    if (success) {
-                        resolve();
-                    } else {
-                        reject(new Error(error));
-                    }
-                });
             }),
             10000,
             new Error(`Timed out getting state of ${command}`)
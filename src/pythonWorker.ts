@@ -0,0 +1,101 @@
+import { Logging } from "homebridge";
+import { ChildProcessWithoutNullStreams, spawn } from "child_process";
+import { createInterface } from "readline";
+import { join } from "path";
+
+type PendingRequest = {
+    resolve: (result: any) => void;
+    reject: (error: Error) => void;
+};
+
+/*
+ * Keeps one main.py process alive and sends it newline delimited JSON requests,
+ * so every HomeKit request reuses the same python interpreter and VW session.
+ */
+export default class PythonWorker {
+    private readonly log: Logging;
+    private readonly config: object;
+    private process: ChildProcessWithoutNullStreams | undefined = undefined;
+    private nextId = 1;
+    private readonly pending = new Map<number, PendingRequest>();
+
+    constructor(log: Logging, config: object) {
+        this.log = log;
+        this.config = config;
+    }
+
+    request(command: string, value: string): Promise<any> {
+        const python = this.start();
+        const id = this.nextId++;
+
+        return new Promise((resolve, reject) => {
+            this.pending.set(id, { resolve, reject });
+            python.stdin.write(JSON.stringify({ id, command, value }) + "\n");
+        });
+    }
+
+    stop() {
+        if (this.process) {
+            this.process.stdin.end();
+            this.process = undefined;
+        }
+    }
+
+    private start(): ChildProcessWithoutNullStreams {
+        if (this.process) {
+            return this.process;
+        }
+
+        const python = spawn(join(__dirname, "/venv/bin/python3"), [
+            join(__dirname, "main.py"),
+            JSON.stringify(this.config),
+            "--worker",
+        ]);
+
+        python.stderr.on("data", (data) => {
+            // logging from python is retrieved by stderr
+            this.log("Python: " + data);
+        });
+
+        createInterface({ input: python.stdout }).on("line", (line) => {
+            let response: any;
+            try {
+                response = JSON.parse(line);
+            } catch (error) {
+                this.log.error(`Python worker sent invalid response: ${line}`);
+                return;
+            }
+
+            const request = this.pending.get(response.id);
+            if (!request || response.progress) {
+                return;
+            }
+            this.pending.delete(response.id);
+
+            if (response.error) {
+                request.reject(new Error(response.error));
+            } else {
+                request.resolve(response.result);
+            }
+        });
+
+        python.on("error", (error) => {
+            this.log.error("Python worker: " + error.message);
+        });
+
+        python.on("close", (code) => {
+            if (this.process === python) {
+                this.process = undefined;
+            }
+            for (const request of this.pending.values()) {
+                request.reject(
+                    new Error(`Python worker exited with code ${code}`)
+                );
+            }
+            this.pending.clear();
+        });
+
+        this.process = python;
+        return python;
+    }
+}
@@ -0,0 +1,88 @@
+import re
+import json
+import time
+import logging
+
+from file_helpers import FileLock
+from retry_policy import remaining
+
+logger = logging.getLogger('RateLimiter')
+
+
+class RateLimiter:
+    """
+    Token buckets per endpoint family, shared by every process of an account
+    through a state file under a file lock.
+
+    A limit of n refills n requests per minute and allows bursts of up to n.
+    """
+
+    FAMILIES = [
+        ('vsr', re.compile(r'/bs/vsr/')),
+        ('climater', re.compile(r'/bs/climatisation/')),
+        ('charger', re.compile(r'/bs/batterycharge/')),
+        ('rolesrights', re.compile(r'/rolesrights/')),
+        ('rlu', re.compile(r'/bs/rlu/')),
+        ('identity', re.compile(r'/(personalData|realCarData|mbbStatusData|identityData)$')),
+    ]
+    LIMITS = {'vsr': 10, 'climater': 10, 'charger': 10,
+              'rolesrights': 6, 'rlu': 4, 'identity': 6}
+
+    def __init__(self, path, limits=None, max_wait=5):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.limits = dict(RateLimiter.LIMITS)
+        self.limits.update(limits or {})
+        self.max_wait = max_wait
+
+    def family(self, command):
+        path = command.split('?')[0]
+        for family, pattern in RateLimiter.FAMILIES:
+            if (pattern.search(path)):
+                return family
+        return None
+
+    def __read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def __take(self, family):
+        # Takes a token and returns 0, or returns the seconds until one is free
+        limit = self.limits[family]
+        with FileLock(self.lock_path):
+            buckets = self.__read()
+            now = time.time()
+            bucket = buckets.get(family, {'tokens': limit, 'timestamp': now})
+            tokens = min(limit, bucket['tokens'] + (now-bucket['timestamp'])*limit/60)
+            if (tokens < 1):
+                return (1-tokens)*60/limit
+            buckets[family] = {'tokens': tokens-1, 'timestamp': now}
+            # Every reader holds the lock too, so an in place write without
+            # fsync is enough. A torn file after a crash only refills the buckets
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(buckets))
+        return 0
+
+    def try_acquire(self, family):
+        if (not family or not self.limits.get(family)):
+            return True
+        return self.__take(family) == 0
+
+    def acquire(self, family):
+        # Queues for up to max_wait seconds, False when the request is shed
+        if (not family or not self.limits.get(family)):
+            return True
+        left = remaining()
+        deadline = time.time()+(self.max_wait if left is None else min(self.max_wait, left))
+        while True:
+            wait = self.__take(family)
+            if (wait == 0):
+                return True
+            if (time.time()+wait > deadline):
+                logger.warning('Rate limit of %s reached, shedding request', family)
+                return False
+            logger.info('Rate limit of %s reached, waiting %.1f s', family, wait)
+            time.sleep(wait)
@@ -0,0 +1,79 @@
+import os
+import re
+import json
+import time
+import logging
+
+from file_helpers import atomic_write
+
+logger = logging.getLogger('Cache')
+
+
+class ResponseCache:
+    """
+    Disk backed cache of decoded responses, one file per VIN and endpoint.
+
+    Entries are replaced atomically so several processes can share the
+    directory. Invalidating a VIN records the time of invalidation, every
+    entry whose request started before that time is ignored from then on.
+    """
+
+    INVALIDATED_FILE = '.invalidated'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __vin_directory(self, vin):
+        return os.path.join(self.directory, re.sub(r'[^\w-]', '_', vin))
+
+    def __path(self, vin, endpoint):
+        return os.path.join(self.__vin_directory(vin), endpoint + '.json')
+
+    def __invalidated_at(self, vin):
+        try:
+            with open(os.path.join(self.__vin_directory(vin), self.INVALIDATED_FILE), 'r') as f:
+                return float(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def get_entry(self, vin, endpoint):
+        try:
+            with open(self.__path(vin, endpoint), 'r') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning('Ignoring unreadable cache entry %s for %s', endpoint, vin)
+            return None
+
+        if (entry['timestamp'] < self.__invalidated_at(vin)):
+            return None
+        return entry
+
+    def get(self, vin, endpoint, ttl):
+        entry = self.get_entry(vin, endpoint)
+        if (entry and entry['timestamp']+ttl > time.time()):
+            logger.debug('Cache hit %s for %s', endpoint, vin)
+            return entry['body']
+        logger.debug('Cache miss %s for %s', endpoint, vin)
+        return None
+
+    def put(self, vin, endpoint, body, timestamp, etag=None, last_modified=None):
+        # timestamp is when the request was sent, a command sent meanwhile wins.
+        # etag and last_modified validate the entry in a conditional request
+        if (timestamp < self.__invalidated_at(vin)):
+            logger.debug('Discarding %s for %s fetched before invalidation', endpoint, vin)
+            return
+        os.makedirs(self.__vin_directory(vin), exist_ok=True)
+        atomic_write(self.__path(vin, endpoint), json.dumps(
+            {'timestamp': timestamp, 'body': body, 'etag': etag, 'last_modified': last_modified}))
+
+    def lock_path(self, vin, endpoint):
+        os.makedirs(self.__vin_directory(vin), exist_ok=True)
+        return os.path.join(self.__vin_directory(vin), endpoint + '.lock')
+
+    def invalidate(self, vin):
+        logger.debug('Invalidating cache for %s', vin)
+        os.makedirs(self.__vin_directory(vin), exist_ok=True)
+        atomic_write(os.path.join(self.__vin_directory(vin),
+                     self.INVALIDATED_FILE), repr(time.time()))
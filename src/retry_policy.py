@@ -0,0 +1,158 @@
+import time
+import random
+import logging
+import threading
+import requests
+import contextvars
+
+from collections import Counter
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger('RetryPolicy')
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Requests in the block stop retrying once seconds have passed, None
+    lifts the deadline of the caller for the block.
+    """
+    token = _deadline.set(time.time()+seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    # Seconds left until the deadline of the caller, None without one
+    end = _deadline.get()
+    return None if end is None else end-time.time()
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed request is sent again.
+
+    Reads are retried on 5xx responses, timeouts and connection errors with
+    exponential backoff and full jitter. Every method is retried on 429,
+    after Retry-After when the server sends one. Writes are never repeated
+    after a 5xx or timeout because the backend may already have acted.
+    Nothing is retried past the deadline of the caller.
+    """
+
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=10, max_retry_after=30):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.counters = Counter()
+        self.__lock = threading.Lock()
+
+    def count(self, name):
+        with self.__lock:
+            self.counters[name] += 1
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if (not value):
+            return None
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp()-time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, method, attempt, response=None, error=None):
+        # Seconds to wait before attempt+1, None when the request must not be retried
+        if (attempt+1 >= self.attempts):
+            return None
+        delay, reason = self.__delay(method, attempt, response, error)
+        left = remaining()
+        if (delay is not None and left is not None and delay >= left):
+            # Nobody is waiting for the answer anymore
+            delay, reason = None, 'deadline'
+        if (reason):
+            self.count(reason)
+        return delay
+
+    def __delay(self, method, attempt, response, error):
+        # (delay, counter) of the retry, (None, counter) when it is given up
+        if (response is not None and response.status_code == 429):
+            delay = self.retry_after(response)
+            if (delay is None):
+                return self.backoff(attempt), 'retries_429'
+            if (delay > self.max_retry_after):
+                # Throttled for longer than anyone waits for a HomeKit tile
+                return None, 'throttled'
+            return delay, 'retries_429'
+
+        if (method != 'GET'):
+            return None, None
+        if (response is not None and response.status_code in self.RETRY_STATUS):
+            return self.backoff(attempt), 'retries_5xx'
+        if (isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))):
+            return self.backoff(attempt), 'retries_timeout'
+        return None, None
+
+
+class CircuitBreaker:
+    """
+    Fails fast for a host after threshold consecutive failures (5xx,
+    timeouts, connection errors). After reset_timeout seconds one request
+    is let through; its success closes the circuit again.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.counters = Counter()
+        self.__failures = {}
+        self.__opened_at = {}
+        self.__probing = set()
+        self.__lock = threading.Lock()
+
+    def allow(self, host):
+        with self.__lock:
+            opened_at = self.__opened_at.get(host)
+            if (opened_at is None):
+                return True
+            if (host not in self.__probing and opened_at+self.reset_timeout <= time.time()):
+                # Half open, this request decides whether the host is back
+                self.__probing.add(host)
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def success(self, host):
+        with self.__lock:
+            self.__failures.pop(host, None)
+            self.__probing.discard(host)
+            if (self.__opened_at.pop(host, None) is not None):
+                logger.info('Circuit for %s closed', host)
+                self.counters['closed'] += 1
+
+    def failure(self, host):
+        with self.__lock:
+            self.__failures[host] = self.__failures.get(host, 0)+1
+            probing = host in self.__probing
+            self.__probing.discard(host)
+            if (probing or (host not in self.__opened_at and self.__failures[host] >= self.threshold)):
+                logger.warning('Circuit for %s opened after %d failures', host, self.__failures[host])
+                self.__opened_at[host] = time.time()
+                self.counters['opened'] += 1
+
+    def open_hosts(self):
+        with self.__lock:
+            return sorted(self.__opened_at)
@@ -0,0 +1,73 @@
+import logging
+import threading
+
+from collections import OrderedDict
+from NativeAPI import WeConnect
+from credentials import Credentials
+from token_scheduler import TokenScheduler
+
+logger = logging.getLogger('SessionPool')
+
+
+class SessionPool:
+    """
+    Logged in WeConnect sessions keyed by (username, password, spin), each
+    with its own connection pool. At most maxSessions are kept, the least
+    recently used one is persisted and dropped when another account needs
+    room, and restored from its session and access files on its next use.
+
+    With a refreshMargin every pooled session gets a TokenScheduler that
+    lives as long as the session stays in the pool.
+    """
+
+    def __init__(self, maxSessions=16, refreshMargin=None, refreshJitter=60):
+        self.maxSessions = max(1, maxSessions)
+        self.refreshMargin = refreshMargin
+        self.refreshJitter = refreshJitter
+        self.__sessions = OrderedDict()
+        self.__schedulers = {}
+        self.__lock = threading.Lock()
+
+    def get(self, credentials) -> WeConnect:
+        key = tuple(credentials)
+        with self.__lock:
+            vwc = self.__sessions.get(key)
+            if vwc is not None:
+                self.__sessions.move_to_end(key)
+                return vwc
+
+            vwc = WeConnect(Credentials(*key))
+            self.__sessions[key] = vwc
+            while len(self.__sessions) > self.maxSessions:
+                self.__evict(*self.__sessions.popitem(last=False))
+            return vwc
+
+    def schedule(self, credentials):
+        # Starts the background refresh once the session has logged in
+        key = tuple(credentials)
+        with self.__lock:
+            vwc = self.__sessions.get(key)
+            if self.refreshMargin is None or vwc is None or key in self.__schedulers:
+                return
+            scheduler = TokenScheduler(vwc, self.refreshMargin, self.refreshJitter)
+            scheduler.start()
+            self.__schedulers[key] = scheduler
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def close(self):
+        with self.__lock:
+            while self.__sessions:
+                self.__evict(*self.__sessions.popitem())
+
+    def __evict(self, key, vwc):
+        # A request still holding vwc keeps working on fresh connections
+        logger.debug('Evicting session of account %s', vwc.account)
+        scheduler = self.__schedulers.pop(key, None)
+        if scheduler:
+            scheduler.stop()
+        try:
+            vwc.persist()
+        except Exception as e:
+            logger.error('Failed to persist session: ' + str(e))
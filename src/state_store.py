@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import car_state_codec
+
+from car_state import CarState
+from car_states import CarStates
+from file_helpers import atomic_write, FileLock
+
+
+class JsonStateStore:
+    """
+    Latest CarState per VIN in carStates.json, without history.
+    """
+
+    keepsHistory = False
+
+    def __init__(self, logger, path='carStates.json'):
+        self.logger = logger
+        self.path = path
+        self.lockPath = path + '.lock'
+
+    def load(self) -> CarStates:
+        with FileLock(self.lockPath, shared=True):
+            return self.read()
+
+    def save(self, carStates: CarStates, vins=None):
+        # Only the states of vins (all when None) are saved and marked clean,
+        # the others may be changing in another thread meanwhile
+        owned = {vin: state for vin, state in carStates.items()
+                 if vins is None or vin in vins}
+        if not any(state.dirtyFields() for state in owned.values()):
+            self.logger.debug('Car states unchanged, skipping save')
+            return
+
+        # Other processes may have saved since we loaded the file, keep the
+        # fields this process set and take everything else from disk. A field
+        # set to the value we last saved still wins, it was just fetched.
+        with FileLock(self.lockPath):
+            saved = self.read()
+            for vin, stored in saved.items():
+                state = owned.get(vin)
+                if state is None:
+                    carStates.setdefault(vin, stored)
+                    continue
+                dirty = state.dirtyFields()
+                for field in CarState.FIELDS:
+                    if field not in dirty:
+                        setattr(state, field, getattr(stored, field))
+            if any(vin not in saved or saved[vin].snapshot() != state.snapshot()
+                   for vin, state in owned.items()):
+                saved.update(owned)
+                atomic_write(self.path, car_state_codec.dumps(saved))
+            else:
+                self.logger.debug('Car states unchanged, skipping save')
+
+        for state in owned.values():
+            state.markClean()
+
+    def record(self, vin, state: CarState, vsr=None):
+        pass
+
+    def read(self) -> CarStates:
+        try:
+            with open(self.path, 'r') as infile:
+                content = infile.read()
+        except FileNotFoundError:
+            return CarStates()
+
+        if not content:
+            return CarStates()
+
+        try:
+            return car_state_codec.loads(content)
+        except Exception as e:
+            # Keep the unreadable file around instead of silently losing it
+            self.logger.warning('Unreadable ' + self.path + ': ' + str(e))
+            try:
+                os.replace(self.path, self.path + '.corrupt')
+            except FileNotFoundError:
+                pass
+            return CarStates()
+
+
+class SqliteStateStore:
+    """
+    Latest CarState per VIN plus an append-only history of every status
+    fetch in a SQLite database in WAL mode, so several processes can read
+    and write it at the same time.
+    """
+
+    keepsHistory = True
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS car_state (
+            vin TEXT PRIMARY KEY,
+            climatisation INTEGER,
+            windowHeating INTEGER,
+            locked INTEGER,
+            batteryLevel INTEGER,
+            charging INTEGER,
+            updated REAL NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS car_state_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vin TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            climatisation INTEGER,
+            windowHeating INTEGER,
+            locked INTEGER,
+            batteryLevel INTEGER,
+            charging INTEGER,
+            vsr TEXT
+        )''',
+        '''CREATE INDEX IF NOT EXISTS car_state_history_vin_timestamp
+            ON car_state_history (vin, timestamp)''',
+    ]
+
+    def __init__(self, logger, path='carStates.db'):
+        self.logger = logger
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.__connection.row_factory = sqlite3.Row
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self.__connection.execute(statement)
+
+    def __values(self, state: CarState):
+        return list(state.snapshot())
+
+    def __decode(self, row) -> CarState:
+        d = {field: row[field] for field in CarState.FIELDS}
+        for field in ('climatisation', 'windowHeating', 'locked', 'charging'):
+            if d[field] is not None:
+                d[field] = bool(d[field])
+        return car_state_codec.decode_state(d)
+
+    def load(self) -> CarStates:
+        with self.__lock:
+            rows = self.__connection.execute(
+                'SELECT * FROM car_state').fetchall()
+        return CarStates({row['vin']: self.__decode(row) for row in rows})
+
+    def get(self, vin) -> CarState:
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT * FROM car_state WHERE vin = ?', (vin,)).fetchone()
+        return self.__decode(row) if row else None
+
+    def save(self, carStates: CarStates, vins=None):
+        changed = {vin: state for vin, state in carStates.items()
+                   if (vins is None or vin in vins) and state.isDirty()}
+        if not changed:
+            self.logger.debug('Car states unchanged, skipping save')
+            return
+
+        now = time.time()
+        with self.__lock:
+            self.__connection.executemany(
+                '''INSERT INTO car_state (vin, climatisation, windowHeating, locked, batteryLevel, charging, updated)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (vin) DO UPDATE SET
+                       climatisation = excluded.climatisation,
+                       windowHeating = excluded.windowHeating,
+                       locked = excluded.locked,
+                       batteryLevel = excluded.batteryLevel,
+                       charging = excluded.charging,
+                       updated = excluded.updated''',
+                [[vin] + self.__values(state) + [now] for vin, state in changed.items()])
+
+        for state in changed.values():
+            state.markClean()
+
+    def record(self, vin, state: CarState, vsr=None):
+        with self.__lock:
+            self.__connection.execute(
+                '''INSERT INTO car_state_history (vin, timestamp, climatisation, windowHeating, locked, batteryLevel, charging, vsr)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                [vin, time.time()] + self.__values(state) + [json.dumps(vsr) if vsr else None])
+
+    def history(self, vin, start=None, end=None):
+        # Snapshots of vin between the start and end timestamps, oldest first
+        with self.__lock:
+            rows = self.__connection.execute(
+                '''SELECT * FROM car_state_history
+                   WHERE vin = ? AND timestamp >= ? AND timestamp <= ?
+                   ORDER BY timestamp''',
+                (vin, start if start is not None else 0, end if end is not None else time.time())).fetchall()
+        entries = []
+        for row in rows:
+            entry = car_state_codec.encode_state(self.__decode(row))
+            entry['timestamp'] = row['timestamp']
+            entry['vsr'] = json.loads(row['vsr']) if row['vsr'] else None
+            entries.append(entry)
+        return entries
+
+
+def createStateStore(config, logger):
+    if config.get('stateStore', 'json') == 'sqlite':
+        return SqliteStateStore(logger, config.get('stateDatabase', 'carStates.db'))
+    return JsonStateStore(logger)
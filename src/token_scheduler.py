@@ -0,0 +1,51 @@
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger('TokenScheduler')
+
+
+class TokenScheduler:
+    """
+    Refreshes the tokens of a WeConnect session in the background, margin
+    seconds (plus up to jitter seconds) before the first one expires, so
+    commands in a long-lived process never wait on authentication.
+    """
+
+    RETRY_DELAY = 60
+    MIN_DELAY = 60
+
+    def __init__(self, vwc, margin=300, jitter=60):
+        self.vwc = vwc
+        self.margin = margin
+        self.jitter = jitter
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(
+            target=self.__run, name='TokenScheduler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def nextRefreshIn(self):
+        expiresAt = self.vwc.tokens_expire_at()
+        if expiresAt is None:
+            return self.RETRY_DELAY
+        refreshAt = expiresAt - self.margin - random.uniform(0, self.jitter)
+        return max(self.MIN_DELAY, refreshAt - time.time())
+
+    def __run(self):
+        delay = self.nextRefreshIn()
+        while not self.__stopped.wait(delay):
+            try:
+                # Covers the jitter window so the tokens due now are refreshed
+                self.vwc.refresh_tokens(self.margin + self.jitter)
+                delay = self.nextRefreshIn()
+            except Exception as e:
+                logger.error('Failed to refresh tokens: ' + str(e))
+                delay = self.RETRY_DELAY
+            logger.debug('Next token refresh in %d seconds', delay)
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+
+from contextlib import contextmanager
+
+logger = logging.getLogger('Tracing')
+
+SUMMARY = 'summary'
+JSONL = 'jsonl'
+
+_current = contextvars.ContextVar('span', default=None)
+_tracer = None
+
+
+class Span:
+    """
+    A timed phase of a command. Spans nest, the outermost one is exported
+    with all of its children once it ends.
+    """
+
+    __slots__ = ('name', 'attributes', 'start', 'duration', 'children', 'id')
+
+    __ids = iter(range(1, sys.maxsize))
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.children = []
+        self.id = next(Span.__ids)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def walk(self, parent=None):
+        # (span, parent) for this span and every span below it
+        yield self, parent
+        for child in list(self.children):
+            yield from child.walk(self)
+
+
+class _NoSpan:
+    # Returned while tracing is off, so callers never need to check
+    def set(self, **attributes):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """
+    Exports finished traces, either one JSON line per span or one summary
+    line per trace, to a file or stderr.
+    """
+
+    def __init__(self, mode=SUMMARY, path=None):
+        if (mode not in (SUMMARY, JSONL)):
+            raise ValueError('Unknown trace mode: ' + mode)
+        self.mode = mode
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def export(self, root):
+        if (self.mode == JSONL):
+            text = ''.join(json.dumps(self.__record(root, span, parent)) + '\n'
+                           for span, parent in root.walk())
+        else:
+            text = self.summary(root) + '\n'
+        with self.__lock:
+            try:
+                if (self.path):
+                    with open(self.path, 'a') as f:
+                        f.write(text)
+                else:
+                    sys.stderr.write(text)
+                    sys.stderr.flush()
+            except OSError as e:
+                logger.error('Failed to write trace: %s', e)
+
+    def __record(self, root, span, parent):
+        record = {'trace': root.id, 'span': span.id,
+                  'parent': parent.id if parent else None, 'name': span.name,
+                  'start': round(span.start, 6), 'ms': round(span.duration * 1000, 1)}
+        record.update(span.attributes)
+        return record
+
+    def summary(self, root):
+        # Total time per phase below the root, in the order they first ran
+        phases = {}
+        requests = received = 0
+        for span, parent in root.walk():
+            if (parent is None):
+                continue
+            phase = phases.setdefault(span.name, [0, 0])
+            phase[0] += 1
+            phase[1] += span.duration
+            if (span.name == 'request'):
+                requests += 1
+                received += span.attributes.get('bytes', 0)
+
+        title = ' '.join([root.name] + [str(v) for v in root.attributes.values() if v not in (None, '')])
+        parts = []
+        for name, (count, duration) in phases.items():
+            parts.append('{}{} {:.1f} ms'.format(name, ' {}x'.format(count) if count > 1 else '', duration * 1000))
+        line = 'trace {}: {:.1f} ms'.format(title, root.duration * 1000)
+        if (parts):
+            line += ' (' + ', '.join(parts) + ')'
+        if (requests):
+            line += ', {} requests, {} bytes'.format(requests, received)
+        return line
+
+
+def configure(mode=None, path=None):
+    # Starts exporting traces, no mode turns tracing off again
+    global _tracer
+    _tracer = Tracer(mode, path) if mode and mode != 'off' else None
+
+
+def enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the block as a child of the current span."""
+    tracer = _tracer
+    if (tracer is None):
+        yield NO_SPAN
+        return
+
+    parent = _current.get()
+    s = Span(name, attributes)
+    if (parent is not None):
+        parent.children.append(s)
+    token = _current.set(s)
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException as e:
+        s.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        s.duration = time.perf_counter() - start
+        _current.reset(token)
+        if (parent is None):
+            tracer.export(s)
+
+
+def bind(fn):
+    """Runs fn in another thread as part of the current span."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+configure(os.environ.get('WECONNECT_TRACE'), os.environ.get('WECONNECT_TRACE_FILE'))
@@ -6,12 +6,58 @@ Created on Mon Jun 28 00:08:42 2021
 @author: trocotronic
 """
 import logging
+from collections.abc import Mapping
+from functools import lru_cache
 
 # Uses logging.basicConfig from main.py
 logger = logging.getLogger('VSR')
 
+OPEN_STATES = {'0': 'n/a', '1': 'open', '2': 'locked', '3': 'closed'}
+
+
+def compile_fields(fields):
+    # Field id -> (group, name, value mapping or None)
+    return {e[1]: (e[2], e[3], e[4] if len(e) == 5 else None) for e in fields}
+
+
+def decode_value(f, mapping):
+    value = 'null'
+    if ('value' in f):
+        if (mapping and f['value'] in mapping):
+            value = mapping[f['value']]
+        else:
+            value = f['value'] if f['value'] else 'null'
+    if ('unit' in f):
+        value += ' '+f['unit']
+    return value
+
+
+class LazyVSR(Mapping):
+    """
+    Parsed VSR whose groups are only decoded when they are first accessed.
+    """
+
+    def __init__(self, vin, raw_groups):
+        self.__raw = raw_groups
+        self.__parsed = {'vin': vin}
+
+    def __getitem__(self, group):
+        if (group not in self.__parsed):
+            raw = self.__raw[group]
+            self.__parsed[group] = {name: decode_value(f, mapping)
+                                    for name, mapping, f in raw}
+        return self.__parsed[group]
+
+    def __iter__(self):
+        yield 'vin'
+        yield from self.__raw
+
+    def __len__(self):
+        return len(self.__raw)+1
+
+
 class VSR:
-    __vsr_fields = [
+    FIELDS = [
         ('0x0101010001', '0x0101010001', 'status', 'utc_time'),
         ('0x0101010002', '0x0101010002', 'status', 'distance_covered'),
         ('0x0203FFFFFF', '0x0203010001', 'intervals', 'distance_to_oil_change'),
@@ -41,43 +87,42 @@ class VSR:
         ('0x0301FFFFFF', '0x030103000A', 'status', 'fuel_level'),
         ('0x0301FFFFFF', '0x030103000B', 'status', 'fuel_method', {'0':'measured', '1':'calculated'}),
         ('0x0301FFFFFF', '0x030103000D', 'status', 'cng_level'),
-        ('0x0301FFFFFF', '0x0301040001', 'doors', 'lock_left_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040002', 'doors', 'open_left_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040003', 'doors', 'safety_left_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040004', 'doors', 'lock_left_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040005', 'doors', 'open_left_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040006', 'doors', 'safety_left_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040007', 'doors', 'lock_right_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040008', 'doors', 'open_right_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040009', 'doors', 'safety_right_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x030104000A', 'doors', 'lock_right_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x030104000B', 'doors', 'open_right_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x030104000C', 'doors', 'safety_right_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x030104000D', 'doors', 'lock_trunk', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x030104000E', 'doors', 'open_trunk', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x030104000F', 'doors', 'safety_trunk', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040010', 'doors', 'lock_hood', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040011', 'doors', 'open_hood', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301040012', 'doors', 'safety_hood', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
-        ('0x0301FFFFFF', '0x0301050001', 'windows', 'state_left_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x0301040001', 'doors', 'lock_left_front', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040002', 'doors', 'open_left_front', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040003', 'doors', 'safety_left_front', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040004', 'doors', 'lock_left_rear', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040005', 'doors', 'open_left_rear', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040006', 'doors', 'safety_left_rear', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040007', 'doors', 'lock_right_front', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040008', 'doors', 'open_right_front', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040009', 'doors', 'safety_right_front', OPEN_STATES),
+        ('0x0301FFFFFF', '0x030104000A', 'doors', 'lock_right_rear', OPEN_STATES),
+        ('0x0301FFFFFF', '0x030104000B', 'doors', 'open_right_rear', OPEN_STATES),
+        ('0x0301FFFFFF', '0x030104000C', 'doors', 'safety_right_rear', OPEN_STATES),
+        ('0x0301FFFFFF', '0x030104000D', 'doors', 'lock_trunk', OPEN_STATES),
+        ('0x0301FFFFFF', '0x030104000E', 'doors', 'open_trunk', OPEN_STATES),
+        ('0x0301FFFFFF', '0x030104000F', 'doors', 'safety_trunk', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040010', 'doors', 'lock_hood', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040011', 'doors', 'open_hood', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301040012', 'doors', 'safety_hood', OPEN_STATES),
+        ('0x0301FFFFFF', '0x0301050001', 'windows', 'state_left_front', OPEN_STATES),
         ('0x0301FFFFFF', '0x0301050002', 'windows', 'position_left_front'),
-        ('0x0301FFFFFF', '0x0301050003', 'windows', 'state_left_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x0301050003', 'windows', 'state_left_rear', OPEN_STATES),
         ('0x0301FFFFFF', '0x0301050004', 'windows', 'position_left_rear'),
-        ('0x0301FFFFFF', '0x0301050005', 'windows', 'state_right_front', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x0301050005', 'windows', 'state_right_front', OPEN_STATES),
         ('0x0301FFFFFF', '0x0301050006', 'windows', 'position_right_front'),
-        ('0x0301FFFFFF', '0x0301050007', 'windows', 'state_right_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x0301050007', 'windows', 'state_right_rear', OPEN_STATES),
         ('0x0301FFFFFF', '0x0301050008', 'windows', 'position_right_rear'),
-        ('0x0301FFFFFF', '0x0301050009', 'windows', 'state_convertible_top', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x0301050009', 'windows', 'state_convertible_top', OPEN_STATES),
         ('0x0301FFFFFF', '0x030105000A', 'windows', 'position_convertible_top'),
-        ('0x0301FFFFFF', '0x030105000B', 'windows', 'state_roof', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x030105000B', 'windows', 'state_roof', OPEN_STATES),
         ('0x0301FFFFFF', '0x030105000C', 'windows', 'position_roof'),
-        ('0x0301FFFFFF', '0x030105000D', 'windows', 'state_roof_rear', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x030105000D', 'windows', 'state_roof_rear', OPEN_STATES),
         ('0x0301FFFFFF', '0x030105000E', 'windows', 'position_roof_rear'),
-        ('0x0301FFFFFF', '0x030105000F', 'windows', 'state_service_flap', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x030105000F', 'windows', 'state_service_flap', OPEN_STATES),
         ('0x0301FFFFFF', '0x0301050010', 'windows', 'position_service_flap'),
-        ('0x0301FFFFFF', '0x0301050011', 'windows', 'state_spoiler', {'0':'n/a', '1':'open', '2':'locked', '3':'closed'}),
+        ('0x0301FFFFFF', '0x0301050011', 'windows', 'state_spoiler', OPEN_STATES),
         ('0x0301FFFFFF', '0x0301050012', 'windows', 'position_spoiler'),
-        
         ('0x0301FFFFFF', '0x0301060001', 'tyre_pressure', 'current_left_front'),
         ('0x0301FFFFFF', '0x0301060002', 'tyre_pressure', 'desired_left_front'),
         ('0x0301FFFFFF', '0x0301060003', 'tyre_pressure', 'current_left_rear'),
@@ -93,57 +138,55 @@ class VSR:
         ('0x0301FFFFFF', '0x030106000D', 'tyre_pressure', 'difference_right_front'),
         ('0x0301FFFFFF', '0x030106000E', 'tyre_pressure', 'difference_right_rear'),
         ('0x0301FFFFFF', '0x030106000F', 'tyre_pressure', 'difference_spare'),
-        ('0x0301FFFFFF', '0x0301060001', 'tyre_pressure', 'current_left_front'),
-        ('0x0301FFFFFF', '0x0301060002', 'tyre_pressure', 'desired_left_front'),
-        ('0x0301FFFFFF', '0x0301060003', 'tyre_pressure', 'current_left_rear'),
-        ('0x0301FFFFFF', '0x0301060004', 'tyre_pressure', 'desired_left_rear'),
-        ('0x0301FFFFFF', '0x0301060005', 'tyre_pressure', 'current_right_front'),
-        ('0x0301FFFFFF', '0x0301060006', 'tyre_pressure', 'desired_right_front'),
-        ('0x0301FFFFFF', '0x0301060007', 'tyre_pressure', 'current_right_rear'),
-        ('0x0301FFFFFF', '0x0301060008', 'tyre_pressure', 'desired_right_rear'),
-        ('0x0301FFFFFF', '0x0301060009', 'tyre_pressure', 'current_spare'),
-        ('0x0301FFFFFF', '0x030106000A', 'tyre_pressure', 'desired_spare'),
-        ('0x0301FFFFFF', '0x030106000B', 'tyre_pressure', 'difference_left_front'),
-        ('0x0301FFFFFF', '0x030106000C', 'tyre_pressure', 'difference_left_rear'),
-        ('0x0301FFFFFF', '0x030106000D', 'tyre_pressure', 'difference_right_front'),
-        ('0x0301FFFFFF', '0x030106000E', 'tyre_pressure', 'difference_right_rear'),
-        
         ]
 
+    # Compiled once so parsing a response is a single pass over its fields
+    __fields = compile_fields(FIELDS)
+
     def __init__(self):
         pass
 
-    def parse(self, j):
-        r = {}
+    @classmethod
+    @lru_cache(maxsize=None)
+    def __select(cls, groups, names):
+        # Compiled index restricted to the wanted groups and field names
+        if (groups is None and names is None):
+            return cls.__fields
+        return {i: e for i, e in cls.__fields.items()
+                if (groups and e[0] in groups) or (names and e[1] in names)}
+
+    def parse(self, j, groups=None, fields=None, lazy=False):
+        """
+        groups and fields limit parsing to those VSR groups (e.g. 'doors')
+        and field names (e.g. 'lock_trunk'), everything else is skipped.
+        With lazy a LazyVSR is returned, decoding each group on first access.
+        """
+        selected = self.__select(frozenset(groups) if groups else None,
+                                 frozenset(fields) if fields else None)
+        partial = selected is not self.__fields
         rr = {}
+        raw = {}
         if ('StoredVehicleDataResponse' in j):
             j = j['StoredVehicleDataResponse']
-            r['VehicleDataResponse'] = {}
             rr['vin'] = j['vin']
             if ('vehicleData' in j and 'data' in j['vehicleData']):
                 for d in j['vehicleData']['data']:
                     if ('id' in d and 'field' in d):
                         for f in d['field']:
-                            found = False
-                            for e in self.__vsr_fields:
-                                if (e[1] == f['id']):
-                                    if (e[2] not in rr):
-                                        rr[e[2]] = {}
-                                    rr[e[2]][e[3]] = 'null'
-                                    if ('value' in f):
-                                        if (len(e) == 5 and f['value'] in e[4]):
-                                            rr[e[2]][e[3]] = e[4][f['value']]
-                                        else:
-                                            rr[e[2]][e[3]
-                                                     ] = f['value'] if f['value'] else 'null'
-                                    if ('unit' in f):
-                                        rr[e[2]][e[3]] += ' '+f['unit']
-                                    # if ('textId' in f):
-                                    #    rr[e[2]][e[3]] += ' ({})'.format(f['textId'])
-                                    found = True
-                                    break
-                            if (not found):
-                                logger.warning(
-                                    '[parse_vsr] item %s, field %s not found', d['id'], f['id'])
-                                logger.warning('[parse_vsr] %s', f)
+                            e = selected.get(f['id'])
+                            if (e is None):
+                                if (not partial):
+                                    logger.warning(
+                                        '[parse_vsr] item %s, field %s not found', d['id'], f['id'])
+                                    logger.warning('[parse_vsr] %s', f)
+                                continue
+                            group, name, mapping = e
+                            if (lazy):
+                                raw.setdefault(group, []).append((name, mapping, f))
+                                continue
+                            if (group not in rr):
+                                rr[group] = {}
+                            rr[group][name] = decode_value(f, mapping)
+        if (lazy):
+            return LazyVSR(rr.get('vin'), raw)
         return rr
@@ -0,0 +1,142 @@
+import sys
+import json
+import functools
+import threading
+import car_state_codec
+
+from concurrent.futures import ThreadPoolExecutor
+from NativeAPI import VWError, WeConnect
+from retry_policy import deadline
+
+
+def errorMessage(error):
+    if isinstance(error, VWError):
+        if 'login.error' in error.message:
+            return 'VWError: Failed to login'
+        return 'VWError: ' + error.message
+    return 'Fatal Error: ' + str(error)
+
+
+def requestId(line):
+    try:
+        return json.loads(line).get('id')
+    except (ValueError, AttributeError):
+        return None
+
+
+def batchLine(vin, state, error):
+    if error is not None:
+        return {'vin': vin, 'error': errorMessage(error)}
+    return {'vin': vin, 'result': car_state_codec.encode_state(state)}
+
+
+class Worker:
+    """
+    Serves newline delimited JSON requests from stdin with one long-lived Car.
+
+    Request:  {"id": 1, "command": "locked", "value": "1"}
+    Response: {"id": 1, "result": {...}} or {"id": 1, "error": "..."}
+
+    The "batch" command fetches every car of the account and first sends
+    {"id": 1, "progress": {"vin": "...", "result": {...}}} for each car as
+    it completes, then {"id": 1, "result": {"vehicles": 2, "failed": 0}}.
+    The "stats" command returns the retry and circuit breaker counters.
+
+    Up to MAX_CONCURRENT_REQUESTS requests are handled at the same time, so
+    responses may arrive in a different order than the requests.
+
+    A request may carry its own "config", otherwise the config the worker
+    was started with is used. The sessions of every account are kept in the
+    Car's SessionPool, which refreshes their tokens in the background.
+    """
+
+    MAX_CONCURRENT_REQUESTS = 8
+
+    def __init__(self, car, config, logger):
+        self.car = car
+        self.config = config
+        self.logger = logger
+
+    def scheduleTokenRefresh(self, config):
+        self.car.pool.schedule(self.car.getCredentials(config))
+
+    def run(self, input=sys.stdin, output=sys.stdout):
+        # Login up front so the first request does not pay for it
+        try:
+            self.car.getConnection(self.config)
+            self.scheduleTokenRefresh(self.config)
+        except Exception as e:
+            self.logger.error(errorMessage(e))
+
+        outputLock = threading.Lock()
+
+        def send(response):
+            with outputLock:
+                output.write(json.dumps(response) + '\n')
+                output.flush()
+
+        def serve(line):
+            for response in self.handle(line):
+                send(response)
+
+        def served(line, future):
+            # handle answers its own errors, this catches the rest (a
+            # response that can not be encoded, a closed output) so the
+            # request is never left without an answer
+            error = future.exception()
+            if error is None:
+                return
+            message = errorMessage(error)
+            self.logger.error(message)
+            try:
+                send({'id': requestId(line), 'error': message})
+            except Exception as e:
+                self.logger.error('Failed to send response: ' + str(e))
+
+        with ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_REQUESTS) as executor:
+            for line in input:
+                line = line.strip()
+                if not line:
+                    continue
+                future = executor.submit(serve, line)
+                future.add_done_callback(functools.partial(served, line))
+
+        self.car.pool.close()
+
+    def handle(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            self.logger.error('Invalid request: ' + line)
+            yield {'id': None, 'error': 'Invalid request'}
+            return
+
+        requestId = request.get('id')
+        config = request.get('config', self.config)
+        command = request.get('command', '')
+        value = str(request.get('value', 'status'))
+
+        try:
+            if command == 'stats':
+                yield {'id': requestId, 'result': WeConnect.transport_stats()}
+                return
+
+            if command == 'batch':
+                vehicles = failed = 0
+                for vin, state, error in self.car.batchStatus(config):
+                    vehicles += 1
+                    failed += error is not None
+                    yield {'id': requestId, 'progress': batchLine(vin, state, error)}
+                self.scheduleTokenRefresh(config)
+                yield {'id': requestId, 'result': {'vehicles': vehicles, 'failed': failed}}
+                return
+
+            # The plugin gives up after requestTimeout, so should the retries
+            with deadline(config.get('requestTimeout', 10)):
+                state = self.car.executeCommand(config, command, value)
+            self.scheduleTokenRefresh(config)
+            yield {'id': requestId, 'result': car_state_codec.encode_state(state)}
+        except Exception as e:
+            message = errorMessage(e)
+            self.logger.error(message)
+            yield {'id': requestId, 'error': message}
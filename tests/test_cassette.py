@@ -0,0 +1,65 @@
+"""
+Records a login and status sequence against the mock VW backend and replays
+it, with passwords that are also keys and values of the recorded requests.
+
+    python3 -m pytest tests
+"""
+import os
+import sys
+import json
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+from mock_backend import MockBackend, install  # noqa: E402
+from bench_cassette import run  # noqa: E402
+from cassette import Cassette, SCRUBBED  # noqa: E402
+
+
+@pytest.fixture
+def backend():
+    logging.disable(logging.ERROR)
+    backend = MockBackend().start()
+    uninstall = install(backend.url)
+    yield backend
+    uninstall()
+    backend.stop()
+    logging.disable(logging.NOTSET)
+
+
+@pytest.mark.parametrize('password', ['status', 'secret', 'client'])
+def test_round_trip_with_common_word_password(backend, tmp_path, monkeypatch, password):
+    path = str(tmp_path / 'status.cassette.json')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('bench_cassette.config', lambda cacheTtl: _config(cacheTtl, password))
+
+    run(Cassette(path, Cassette.RECORD))
+    with open(path) as f:
+        text = f.read()
+    interactions = json.loads(text)['interactions']
+
+    # Keys and paths are left alone, the password only goes at its form field
+    assert 'client_id=' in text and 'client_secret' in text and '/status"' in text
+    bodies = [i['request']['body'] for i in interactions if isinstance(i['request']['body'], dict)]
+    assert any(body.get('password') == SCRUBBED for body in bodies)
+    assert not any(password == value for body in bodies for value in body.values())
+
+    # Learned from later responses, scrubbed from the earlier ones too
+    for secret in ('mock-email-hmac', 'mock-password-hmac', 'mock-csrf-token', 'Mustermann', '1980-01-01'):
+        assert secret not in text
+
+    backend.stop()
+    for name in os.listdir(tmp_path):
+        if name.startswith('weconnectAPI') or name.startswith('carStates'):
+            os.unlink(os.path.join(tmp_path, name))
+    run(Cassette(path, Cassette.REPLAY))
+
+
+def _config(cacheTtl, password):
+    from bench_commands import config
+    cfg = config(cacheTtl)
+    cfg['password'] = password
+    return cfg
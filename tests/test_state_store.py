@@ -0,0 +1,61 @@
+"""
+Two processes sharing carStates.json, each with its own JsonStateStore and
+in-memory car states.
+
+    python3 -m pytest tests
+"""
+import os
+import sys
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import state_store  # noqa: E402
+from car_state import CarState  # noqa: E402
+from state_store import JsonStateStore  # noqa: E402
+
+VIN = 'WVWZZZ3CZLE0000001'
+
+
+def stores(tmp_path):
+    path = str(tmp_path / 'carStates.json')
+    logger = logging.getLogger('Test')
+    return JsonStateStore(logger, path), JsonStateStore(logger, path)
+
+
+def test_fetched_value_wins_over_other_process(tmp_path):
+    storeA, storeB = stores(tmp_path)
+    a = storeA.load()
+    a[VIN] = CarState()
+    a[VIN].locked = True
+    storeA.save(a, [VIN])
+
+    b = storeB.load()
+    b[VIN].locked = False
+    b[VIN].charging = True
+    storeB.save(b, [VIN])
+
+    # A fetches the lock status again, the same value it saved before
+    a[VIN].locked = True
+    storeA.save(a, [VIN])
+
+    assert a[VIN].locked is True
+    assert a[VIN].charging is True
+    assert storeB.load()[VIN].locked is True
+
+
+def test_unchanged_fetch_does_not_write(tmp_path, monkeypatch):
+    storeA, _ = stores(tmp_path)
+    a = storeA.load()
+    a[VIN] = CarState()
+    a[VIN].locked = True
+    storeA.save(a, [VIN])
+
+    writes = []
+    monkeypatch.setattr(state_store, 'atomic_write', lambda *args, **kwargs: writes.append(args))
+    storeA.save(a, [VIN])
+    a[VIN].locked = True
+    storeA.save(a, [VIN])
+
+    assert writes == []
+    assert not a[VIN].isDirty()